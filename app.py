@@ -1,23 +1,28 @@
+import io
 import os
 import re
 import sys
+import csv
 import json
+import math
 import time
 import uuid
-import yaml
 import shutil
 import codecs
 import signal
 import fnmatch
+import hashlib
+import argparse
 import platform
 import datetime
 import builtins
+import itertools
 import threading
 import traceback
-from PIL import Image
 from tqdm import tqdm
+from array import array
 from functools import partial
-from multiprocessing import Pool
+from collections import Counter
 from pathlib import Path, WindowsPath
 
 
@@ -98,355 +103,3578 @@ class CustomEnvironment:
 
 
 class Config:
+    # bump this when the compiled layout below changes, so old caches are ignored
+    cache_version = 12
+
+    path_keys = [
+        "root_dir",
+        "completion_json",
+        "history_file",
+        "checkpoint_file",
+        "leftovers_report",
+        "image_hash_cache",
+        "similar_images_report",
+        "video_fingerprint_cache",
+        "duplicate_videos_report",
+        "metadata_cache",
+        "metadata_index",
+        "thumbnail_dir",
+        "recompress_cache",
+        "blacklist_hash_cache",
+        "previous_index",
+        "run_diff_report",
+    ]
+    required_keys = ["root_dir", "completion_json", "history_file"]
+
+    defaults = {
+        "version": "",
+        "author": "",
+        "checkpoint_file": None,
+        "leftovers_report": None,
+        "premium_directory": "premium",
+        "output_attributes": False,
+        "is_dry_run": True,
+        "is_debug": False,
+        "do_imports": False,
+        "do_renames": False,
+        "do_renames_lowercase": False,
+        "do_converts": False,
+        "do_clean_duplicate_extensions": False,
+        "do_premium_imports": False,
+        "do_loose_file_imports": False,
+        "do_image_converts": False,
+        "do_video_converts": False,
+        "do_import_coomer": False,
+        "do_import_fanhouse": False,
+        "do_import_fansly": False,
+        "do_import_gumroad": False,
+        "do_import_onlyfans": False,
+        "do_import_patreon": False,
+        "do_import_ppv": False,
+        "move_workers": 4,
+        "move_bandwidth_limit": 0,
+        "move_verify_hash": True,
+        "async_disk_limit": 16,
+        "async_encoder_limit": 2,
+        "async_probe_limit": 8,
+        "async_max_in_flight": 512,
+        "do_find_similar_images": False,
+        "similar_images_hash": "dhash",
+        "similar_images_threshold": 6,
+        "image_hash_cache": None,
+        "similar_images_report": None,
+        "do_find_duplicate_videos": False,
+        "video_fingerprint_workers": 2,
+        "video_fingerprint_threshold": 8,
+        "video_fingerprint_cache": None,
+        "duplicate_videos_report": None,
+        "do_extract_metadata": False,
+        "metadata_workers": 8,
+        "metadata_cache": None,
+        "metadata_index": None,
+        "do_thumbnails": False,
+        "thumbnail_workers": 4,
+        "thumbnail_size": 256,
+        "thumbnail_sheet_frames": 4,
+        "thumbnail_dir": None,
+        "do_recompress_images": False,
+        "recompress_quality": 85,
+        "recompress_lossless_webp": False,
+        "recompress_min_savings": 10,
+        "recompress_cache": None,
+        "transcode_profile": "fast",
+        "transcode_timeout": 1800,
+        "transcode_profiles": {
+            "fast": {"preset": "veryfast", "crf": 23, "threads": 0},
+            "balanced": {"preset": "medium", "crf": 21, "threads": 0},
+            "small": {"preset": "slow", "crf": 26, "threads": 0},
+        },
+        "do_archive_imports": False,
+        "archive_workers": 2,
+        "archive_max_member_size": 4096,
+        "archive_max_total_size": 32768,
+        "archive_extractor": "7z",
+        "archive_delete_after_import": False,
+        "do_query_index": False,
+        "do_run_diff": False,
+        "previous_index": None,
+        "run_diff_report": None,
+        "valid_filetypes": {"images": [], "videos": []},
+        "goal_video_extensions": [],
+        "goal_image_extensions": [],
+        "convertable_video_extensions": [],
+        "convertable_image_extensions": [],
+        "protected_models": [],
+        "protected_dirs": [],
+        "blacklisted_files": [],
+        "blacklist_hash_cache": None,
+    }
+
+    # (section, key) in the nested 0.3.0 layout -> key in the flat 0.2.x layout
+    nested_keys = {
+        ("paths", "root_dir"): "root_dir",
+        ("paths", "completion_json"): "completion_json",
+        ("paths", "history_file"): "history_file",
+        ("paths", "checkpoint_file"): "checkpoint_file",
+        ("paths", "leftovers_report"): "leftovers_report",
+        ("paths", "premium_directory"): "premium_directory",
+        ("debug_settings", "output_attributes"): "output_attributes",
+        ("debug_settings", "is_dry_run"): "is_dry_run",
+        ("debug_settings", "is_debug"): "is_debug",
+        ("conversion_options", "do_converts"): "do_converts",
+        ("conversion_options", "do_images"): "do_image_converts",
+        ("conversion_options", "do_videos"): "do_video_converts",
+        ("conversion_options", "goal_video_extensions"): "goal_video_extensions",
+        ("conversion_options", "goal_image_extensions"): "goal_image_extensions",
+        (
+            "conversion_options",
+            "convertable_video_extensions",
+        ): "convertable_video_extensions",
+        (
+            "conversion_options",
+            "convertable_image_extensions",
+        ): "convertable_image_extensions",
+        ("rename_options", "do_renames"): "do_renames",
+        ("rename_options", "do_lowercase"): "do_renames_lowercase",
+        ("rename_options", "do_duplicate_extensions"): "do_clean_duplicate_extensions",
+        ("import_options", "do_imports"): "do_imports",
+        ("import_options", "do_premium"): "do_premium_imports",
+        ("import_options", "do_loose_files"): "do_loose_file_imports",
+        ("import_fan_platforms", "do_coomer"): "do_import_coomer",
+        ("import_fan_platforms", "do_fanhouse"): "do_import_fanhouse",
+        ("import_fan_platforms", "do_fansly"): "do_import_fansly",
+        ("import_fan_platforms", "do_gumroad"): "do_import_gumroad",
+        ("import_fan_platforms", "do_onlyfans"): "do_import_onlyfans",
+        ("import_fan_platforms", "do_patreon"): "do_import_patreon",
+        ("import_fan_platforms", "do_ppv"): "do_import_ppv",
+        ("excluded_directories", "models"): "protected_models",
+        ("excluded_directories", "general"): "protected_dirs",
+        ("excluded_directories", "files"): "blacklisted_files",
+        ("filetypes", "valid_filetypes"): "valid_filetypes",
+    }
+
     def __init__(self):
         self.config_path = Path(__file__).parent / "config.yaml"
         self.load_config()
 
     def load_config(self):
-        with open(self.config_path, "r") as f:
-            self.config = yaml.safe_load(f)
+        # the compiled config is cached next to config.yaml, keyed by its contents
+        # so yaml is only imported and validated again after the file changes
+
+        with open(self.config_path, "rb") as f:
+            content = f.read()
+
+        cache_path = self.config_path.with_name(f".{self.config_path.name}.cache")
+        cache_key = self.get_cache_key(content)
+
+        self.config = self.load_cached_config(cache_path, cache_key)
+        if self.config is not None:
+            return
+
+        import yaml
+
+        raw_config = yaml.safe_load(content) or dict()
+        config = self.normalize_config(raw_config)
+        self.validate_config(config)
+        self.config = self.compile_config(config)
+
+        self.save_cached_config(cache_path, cache_key)
+
+    def get_cache_key(self, content) -> str:
+        cache_key = hashlib.sha256(content)
+        cache_key.update(f"{self.cache_version}:{self.config_path.resolve()}".encode())
+        return cache_key.hexdigest()
+
+    def load_cached_config(self, cache_path, cache_key):
+        import pickle
+
+        try:
+            with open(cache_path, "rb") as f:
+                cached = pickle.load(f)
+        except Exception:
+            return None
+
+        if not isinstance(cached, dict) or cached.get("key") != cache_key:
+            return None
+
+        return cached["config"]
+
+    def save_cached_config(self, cache_path, cache_key) -> None:
+        import pickle
+
+        temp_path = cache_path.with_name(cache_path.name + ".tmp")
+        try:
+            with open(temp_path, "wb") as f:
+                pickle.dump({"key": cache_key, "config": self.config}, f)
+            os.replace(temp_path, cache_path)
+        except OSError:
+            # a read-only install just compiles the config on every run
+            pass
+
+    def normalize_config(self, raw_config) -> dict:
+        # flatten the nested 0.3.0 layout, then fill in defaults for missing keys
+
+        if not isinstance(raw_config, dict):
+            raise ValueError(f"{self.config_path} must contain a mapping")
+
+        config = dict()
+        sections = set(section for section, _ in self.nested_keys)
+
+        for key, value in raw_config.items():
+            if key in sections and isinstance(value, dict):
+                for nested_key, nested_value in value.items():
+                    flat_key = self.nested_keys.get((key, nested_key), nested_key)
+                    config[flat_key] = nested_value
+            else:
+                config[key] = value
+
+        for key, value in self.defaults.items():
+            if key not in config or config[key] is None:
+                config[key] = value
+
+        return config
+
+    def validate_config(self, config) -> None:
+        errors = list()
+
+        for key in self.required_keys:
+            if not config.get(key):
+                errors.append(f"{key} is required")
+
+        for key, default in self.defaults.items():
+            value = config[key]
+            if value is None or default is None:
+                continue
+
+            if isinstance(default, bool):
+                if not isinstance(value, bool):
+                    errors.append(f"{key} must be true or false, got {value!r}")
+            elif isinstance(default, (int, float)):
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    errors.append(f"{key} must be a number, got {value!r}")
+                elif value < 0:
+                    errors.append(f"{key} must not be negative, got {value!r}")
+            elif isinstance(default, list):
+                if not isinstance(value, list) or not all(
+                    isinstance(item, str) for item in value
+                ):
+                    errors.append(f"{key} must be a list of strings")
+            elif isinstance(default, str):
+                if not isinstance(value, (str, int, float)):
+                    errors.append(f"{key} must be a string, got {value!r}")
+
+        valid_filetypes = config["valid_filetypes"]
+        if not isinstance(valid_filetypes, dict):
+            errors.append("valid_filetypes must map a subfolder to a list of extensions")
+        else:
+            for category in ["images", "videos"]:
+                if category not in valid_filetypes:
+                    errors.append(f"valid_filetypes must have an {category} list")
+
+            for category, extensions in valid_filetypes.items():
+                if not isinstance(extensions, list):
+                    errors.append(f"valid_filetypes.{category} must be a list")
+                    continue
+                errors.extend(self.get_extension_errors(category, extensions))
+
+        for key in [
+            "goal_video_extensions",
+            "goal_image_extensions",
+            "convertable_video_extensions",
+            "convertable_image_extensions",
+        ]:
+            if isinstance(config[key], list):
+                errors.extend(self.get_extension_errors(key, config[key]))
+
+        transcode_profiles = config["transcode_profiles"]
+        if not isinstance(transcode_profiles, dict) or not all(
+            isinstance(profile, dict) for profile in transcode_profiles.values()
+        ):
+            errors.append("transcode_profiles must map a name to profile options")
+        elif config["transcode_profile"] not in transcode_profiles:
+            errors.append(
+                f"transcode_profile {config['transcode_profile']!r} "
+                "is not in transcode_profiles"
+            )
+        else:
+            for name, profile in transcode_profiles.items():
+                unknown_keys = set(profile) - set(VideoConverter.default_profile)
+                if unknown_keys:
+                    errors.append(
+                        f"transcode_profiles.{name} has unknown options: "
+                        + ", ".join(sorted(unknown_keys))
+                    )
+
+        if config["similar_images_hash"] not in ["ahash", "dhash", "phash"]:
+            errors.append("similar_images_hash must be one of ahash, dhash, phash")
+
+        # the types were checked above, only the ranges are left
+        recompress_quality = config["recompress_quality"]
+        if isinstance(recompress_quality, int) and not 1 <= recompress_quality <= 95:
+            errors.append("recompress_quality must be between 1 and 95")
+
+        min_savings = config["recompress_min_savings"]
+        if isinstance(min_savings, (int, float)) and min_savings >= 100:
+            errors.append("recompress_min_savings must be a percentage below 100")
+
+        if (
+            config["recompress_lossless_webp"]
+            and ".webp" not in config["goal_image_extensions"]
+        ):
+            errors.append(
+                "recompress_lossless_webp needs .webp in goal_image_extensions"
+            )
+
+        if errors:
+            raise ValueError(
+                f"Invalid config {self.config_path}:\n  - " + "\n  - ".join(errors)
+            )
+
+    def get_extension_errors(self, key, extensions) -> list:
+        return [
+            f"{key}: {extension!r} must start with a dot"
+            for extension in extensions
+            if not isinstance(extension, str) or not extension.startswith(".")
+        ]
+
+    def compile_config(self, config) -> dict:
+        # convert paths once and precompute the lookup structures used per file
+
+        config = dict(config)
+
+        for key in self.path_keys:
+            if config[key] is not None:
+                config[key] = Path(config[key])
+
+        if config["checkpoint_file"] is None:
+            config["checkpoint_file"] = config["history_file"].with_name(
+                "checkpoint.jsonl"
+            )
+
+        if config["image_hash_cache"] is None:
+            config["image_hash_cache"] = config["history_file"].with_name(
+                "image_hashes.json"
+            )
+
+        if config["metadata_cache"] is None:
+            config["metadata_cache"] = config["history_file"].with_name(
+                "metadata_cache.json"
+            )
+
+        if config["metadata_index"] is None:
+            config["metadata_index"] = config["completion_json"].with_name(
+                "metadata.json"
+            )
+
+        if config["thumbnail_dir"] is None:
+            config["thumbnail_dir"] = config["history_file"].with_name("thumbnails")
+
+        if config["previous_index"] is None:
+            completion_json = config["completion_json"]
+            config["previous_index"] = completion_json.with_name(
+                f"{completion_json.stem}.previous.jsonl"
+            )
+
+        if config["blacklist_hash_cache"] is None:
+            config["blacklist_hash_cache"] = config["history_file"].with_name(
+                "blacklist_hashes.json"
+            )
+
+        if config["recompress_cache"] is None:
+            config["recompress_cache"] = config["history_file"].with_name(
+                "recompress_cache.json"
+            )
+
+        if config["video_fingerprint_cache"] is None:
+            config["video_fingerprint_cache"] = config["history_file"].with_name(
+                "video_fingerprints.json"
+            )
+
+        config["version"] = str(config["version"])
+        config["premium_directory"] = str(config["premium_directory"])
+
+        valid_filetypes = config["valid_filetypes"]
+        config["image_extensions"] = frozenset(valid_filetypes["images"])
+        config["video_extensions"] = frozenset(valid_filetypes["videos"])
+        config["possible_extensions"] = (
+            valid_filetypes["videos"] + valid_filetypes["images"]
+        )
+
+        # the first subfolder listing an extension wins, like the old loop did
+        extension_subfolders = dict()
+        for subfolder, extensions in valid_filetypes.items():
+            for extension in extensions:
+                extension_subfolders.setdefault(extension, subfolder)
+        config["extension_subfolders"] = extension_subfolders
+
+        for key in [
+            "goal_video_extensions",
+            "goal_image_extensions",
+            "convertable_video_extensions",
+            "convertable_image_extensions",
+        ]:
+            config[key] = frozenset(config[key])
+
+        config["blacklisted_files"] = Blacklist(config["blacklisted_files"])
+
+        # plain names are set lookups, only real globs go through the regex
+        excluded_dir_names, excluded_dir_globs = split_glob_patterns(
+            config["protected_dirs"]
+        )
+        config["excluded_dir_names"] = frozenset(
+            os.path.normcase(name) for name in excluded_dir_names
+        )
+        config["excluded_dir_pattern"] = compile_glob_pattern(excluded_dir_globs)
+        config["protected_model_names"] = frozenset(
+            os.path.normcase(model) for model in config["protected_models"]
+        )
+
+        return config
 
     def get_value(self, key):
-        value = self.config.get(key)
-        if key in ["root_dir", "completion_json", "history_file"]:
-            value = Path(value)
-        return value
+        return self.config.get(key)
 
     def set_value(self, key, value):
         self.config[key] = value
 
 
-class History:
-    def __init__(self, history_file):
-        self.history_file = history_file
-        self.history = self.load_history()
+def split_glob_patterns(patterns):
+    # separate plain names from fnmatch patterns
 
-    def append_to_history(self, input_path, output_path):
-        timestamp = datetime.datetime.now().timestamp()
-        identifier = uuid.uuid4()
+    names, globs = list(), list()
+    for pattern in patterns:
+        if any(char in pattern for char in "*?["):
+            globs.append(pattern)
+        else:
+            names.append(pattern)
 
-        entry = {
-            "input_path": str(input_path),
-            "output_path": str(output_path),
-            "timestamp": str(timestamp),
-        }
+    return names, globs
 
-        self.history[str(identifier)] = entry
 
-    def load_history(self):
-        if self.history_file.exists():
-            with open(self.history_file, "r") as f:
+def compile_glob_pattern(patterns):
+    # one regex for a list of fnmatch patterns, None when there are none
+    # case-insensitive where fnmatch is (windows)
+
+    if not patterns:
+        return None
+
+    flags = re.IGNORECASE if os.path.normcase("A") == "a" else 0
+    return re.compile(
+        "|".join(f"(?:{fnmatch.translate(pattern)})" for pattern in patterns),
+        flags,
+    )
+
+
+class Blacklist:
+    # blacklisted_files entries can be
+    #   an exact path:      D:/Content/ISOs/unknown/image.jpg
+    #   an fnmatch pattern: D:/Content/ISOs/unknown/*.wmv
+    #   a content hash:     sha256:<hex digest>
+    # exact paths and hashes are set lookups, all patterns share one regex
+    # FileProcessor.is_blacklisted checks a file, its hashes are cached by identity
+
+    hash_prefix = "sha256:"
+
+    def __init__(self, entries=()):
+        path_entries = list()
+        self.hashes = set()
+
+        for entry in entries:
+            if self.is_hash_entry(entry):
+                self.hashes.add(entry[len(self.hash_prefix) :].strip().lower())
+            else:
+                path_entries.append(entry)
+
+        paths, globs = split_glob_patterns(path_entries)
+        self.paths = set(self.normalize(path) for path in paths)
+        self.pattern = compile_glob_pattern([self.normalize(glob) for glob in globs])
+
+    def is_hash_entry(self, entry) -> bool:
+        return entry.lower().startswith(self.hash_prefix)
+
+    def normalize(self, path) -> str:
+        return os.path.normcase(os.path.normpath(str(path)))
+
+    def matches_path(self, file_path) -> bool:
+        normalized = self.normalize(file_path)
+
+        if normalized in self.paths:
+            return True
+
+        return self.pattern is not None and bool(self.pattern.match(normalized))
+
+    def __len__(self) -> int:
+        return len(self.paths) + len(self.hashes) + (self.pattern is not None)
+
+    def get_file_hash(self, file_path) -> str:
+        file_hash = hashlib.sha256()
+        try:
+            with open(file_path, "rb") as f:
+                for chunk in iter(partial(f.read, 1024 * 1024), b""):
+                    file_hash.update(chunk)
+        except OSError:
+            return ""
+
+        return file_hash.hexdigest()
+
+
+class IdentityCache:
+    # json cache of per-file results keyed by file identity (device, inode, size, mtime)
+    # a changed or replaced file gets a new key, so stale results are never reused
+
+    def __init__(self, cache_file, prefix=""):
+        self.cache_file = cache_file
+        self.prefix = prefix
+        self.entries = dict()
+
+    def load(self) -> None:
+        if self.cache_file.exists():
+            with open(self.cache_file, "r", encoding="utf-8") as f:
                 file_content = f.read()
                 if file_content:
-                    return json.loads(file_content)
-        return dict()
+                    self.entries = json.loads(file_content)
 
-    def save_history(self):
-        self.backup_history()
-        with open(self.history_file, "w") as f:
-            json.dump(self.history, f, indent=4)
+    def save(self, used_keys, prune=True) -> None:
+        # files that are gone are dropped so the cache doesn't grow forever
+        # a resumed or sharded run didn't look at every file, so it keeps the rest
 
-    def backup_history(self):
-        history_file_backup = self.history_file.with_suffix(".bak")
+        if prune:
+            self.entries = {
+                key: self.entries[key] for key in used_keys if key in self.entries
+            }
+
+        self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        with open(self.cache_file, "w", encoding="utf-8") as f:
+            json.dump(self.entries, f)
+
+    def get_key(self, file_path):
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            return None
+
+        return (
+            f"{self.prefix}{stat.st_dev}:{stat.st_ino}:"
+            f"{stat.st_size}:{stat.st_mtime_ns}"
+        )
+
+
+def compute_image_hash(task):
+    # runs in a worker process, so it has to be a module level function
+    # returns (file_path, hash) with hash None when the image can't be read
+
+    file_path, hash_type = task
+
+    import numpy
+    from PIL import Image
+
+    hash_sizes = {"ahash": (8, 8), "dhash": (9, 8), "phash": (32, 32)}
+
+    try:
+        with Image.open(file_path) as image:
+            # jpegs decode straight to a small grayscale image
+            image.draft("L", (64, 64))
+            image = image.convert("L")
+
+            factor = min(image.width, image.height) // 64
+            if factor > 1:
+                image = image.reduce(factor)
+
+            image = image.resize(hash_sizes[hash_type], Image.BILINEAR)
+            pixels = numpy.asarray(image, dtype=numpy.float32)
+
+    except Exception:
+        return file_path, None
+
+    if hash_type == "ahash":
+        bits = pixels > pixels.mean()
+    elif hash_type == "dhash":
+        bits = pixels[:, 1:] > pixels[:, :-1]
+    else:
+        size = pixels.shape[0]
+        positions = numpy.arange(size)
+        dct_matrix = numpy.cos(
+            numpy.pi * numpy.outer(positions, 2 * positions + 1) / (2 * size)
+        )
+        low_frequencies = (dct_matrix @ pixels @ dct_matrix.T)[:8, :8]
+        bits = low_frequencies > numpy.median(low_frequencies.flatten()[1:])
+
+    value = 0
+    for bit in bits.flatten():
+        value = (value << 1) | int(bit)
+
+    return file_path, value
+
+
+def recompress_image(task):
+    # runs in a worker process, so it has to be a module level function
+    # returns (file_path, output_path, old_size, new_size)
+    # output_path is None when the image is kept, new_size is None when it can't be read
+    # jpegs are encoded again in place, lossless formats can become lossless webp
+
+    file_path, quality, lossless_webp, min_savings, is_dry_run = task
+
+    from PIL import Image
+
+    input_path = Path(file_path)
+    suffix = input_path.suffix.lower()
+    temp_path = input_path.with_name(f"{input_path.name}.{uuid.uuid4().hex}.part")
+    # a dry run only needs the size, so nothing is written next to the image
+    target = io.BytesIO() if is_dry_run else temp_path
+
+    try:
+        old_size = input_path.stat().st_size
+
+        with Image.open(input_path) as image:
+            if image.format == "JPEG" and suffix in [".jpg", ".jpeg"]:
+                output_path = input_path
+                image.save(
+                    target,
+                    "JPEG",
+                    quality=quality,
+                    optimize=True,
+                    progressive=True,
+                    exif=image.info.get("exif", b""),
+                    icc_profile=image.info.get("icc_profile"),
+                )
+
+            elif (
+                lossless_webp
+                and image.format in ["PNG", "BMP", "TIFF"]
+                and image.mode in ["1", "L", "LA", "P", "PA", "RGB", "RGBA"]
+                and not getattr(image, "is_animated", False)
+            ):
+                output_path = input_path.with_suffix(".webp")
+                if output_path.exists():
+                    return file_path, None, old_size, old_size
+
+                has_alpha = "A" in image.mode or "transparency" in image.info
+                image = image.convert("RGBA" if has_alpha else "RGB")
+                image.save(
+                    target,
+                    "WEBP",
+                    lossless=True,
+                    exif=image.info.get("exif", b""),
+                    icc_profile=image.info.get("icc_profile"),
+                )
 
-        if self.history_file.exists():
-            if not history_file_backup.exists():
-                shutil.copy(self.history_file, history_file_backup)
             else:
-                if (
-                    self.history_file.stat().st_size
-                    > history_file_backup.stat().st_size
-                ):
-                    shutil.copy(self.history_file, history_file_backup)
+                return file_path, None, old_size, old_size
 
+        if is_dry_run:
+            new_size = target.getbuffer().nbytes
+        else:
+            new_size = temp_path.stat().st_size
+
+        if new_size > old_size * (100 - min_savings) / 100:
+            if not is_dry_run:
+                temp_path.unlink()
+            return file_path, None, old_size, old_size
+
+        if not is_dry_run:
+            os.replace(temp_path, output_path)
+            if output_path != input_path:
+                input_path.unlink()
+
+        return file_path, str(output_path), old_size, new_size
+
+    except Exception:
+        if temp_path.exists():
+            temp_path.unlink()
+        return file_path, None, None, None
+
+
+def cluster_matches(items, matches) -> list:
+    # join matching pairs with union-find, returns the clusters with more than one item
+
+    parents = {item: item for item in items}
+
+    def find(item):
+        while parents[item] != item:
+            parents[item] = parents[parents[item]]
+            item = parents[item]
+        return item
+
+    for first, second in matches:
+        parents[find(first)] = find(second)
+
+    clusters = dict()
+    for item in parents:
+        clusters.setdefault(find(item), list()).append(item)
+
+    return [sorted(cluster) for cluster in clusters.values() if len(cluster) > 1]
+
+
+class BKTree:
+    # metric tree over 64 bit hashes using hamming distance
+    # a search only visits children whose edge distance can still be in range
 
-class VideoConverter:
     def __init__(self):
-        self.conversion_success = False
-        self.is_mp4 = False
+        self.root = None
 
-    def run_conversion(self, cmd, output_file):
-        import subprocess
+    def get_distance(self, first, second) -> int:
+        return bin(first ^ second).count("1")
 
-        conversion_success = False
-        is_mp4 = False
-        timeout = 45
-        start_time = time.time()
+    def add(self, value, item) -> None:
+        # a node is [value, items, {distance: child}]
+
+        if self.root is None:
+            self.root = [value, [item], dict()]
+            return
+
+        node = self.root
+        while True:
+            distance = self.get_distance(value, node[0])
+            if distance == 0:
+                node[1].append(item)
+                return
+
+            child = node[2].get(distance)
+            if child is None:
+                node[2][distance] = [value, [item], dict()]
+                return
+
+            node = child
+
+    def search(self, value, radius) -> list:
+        if self.root is None:
+            return list()
+
+        found = list()
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            distance = self.get_distance(value, node[0])
+            if distance <= radius:
+                found.extend(node[1])
+
+            for child_distance, child in node[2].items():
+                if distance - radius <= child_distance <= distance + radius:
+                    nodes.append(child)
+
+        return found
+
+
+class SimilarImageFinder:
+    def __init__(self, cache_file, hash_type="dhash", threshold=6, num_processes=4):
+        # perceptual hashes are cached by file identity (device, inode, size, mtime)
+        # so only new or changed images are decoded on later runs
+
+        self.hash_type = hash_type
+        self.threshold = threshold
+        self.num_processes = max(1, num_processes)
+        self.cache = IdentityCache(cache_file, prefix=f"{hash_type}:")
+
+    def get_hashes(self, image_paths, prune=True) -> dict:
+        from multiprocessing import Pool
+
+        self.cache.load()
+
+        hashes = dict()
+        cache_keys = dict()
+        to_hash = list()
+
+        for image_path in image_paths:
+            cache_key = self.cache.get_key(image_path)
+            if cache_key is None:
+                continue
+
+            cache_keys[image_path] = cache_key
+            if cache_key in self.cache.entries:
+                hashes[image_path] = int(self.cache.entries[cache_key], 16)
+            else:
+                to_hash.append((image_path, self.hash_type))
+
+        if to_hash:
+            with Pool(processes=self.num_processes) as pool:
+                results = pool.imap_unordered(
+                    compute_image_hash, to_hash, chunksize=32
+                )
+                for image_path, value in tqdm(
+                    results,
+                    total=len(to_hash),
+                    desc="    Hashing images",
+                    unit=" images",
+                    leave=False,
+                ):
+                    if value is None:
+                        continue
+                    hashes[image_path] = value
+                    self.cache.entries[cache_keys[image_path]] = f"{value:016x}"
+
+        self.cache.save(cache_keys.values(), prune)
+
+        return hashes
+
+    def find_clusters(self, image_paths, prune=True) -> list:
+        hashes = self.get_hashes(image_paths, prune)
+        return cluster_matches(hashes, self.get_matches(hashes))
+
+    def get_matches(self, hashes):
+        # each image is matched against the tree of the images before it
+
+        tree = BKTree()
+        for image_path, value in hashes.items():
+            for match in tree.search(value, self.threshold):
+                yield match, image_path
+
+            tree.add(value, image_path)
+
+
+def get_video_duration(file_path):
+    import subprocess
+
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_entries",
+                "format=duration",
+                "-of",
+                "json",
+                str(file_path),
+            ],
+            capture_output=True,
+            timeout=60,
+        )
+        return float(json.loads(result.stdout)["format"]["duration"])
+    except Exception:
+        return None
 
-        def conversion_thread():
-            nonlocal conversion_success, is_mp4
-            process = subprocess.Popen(
-                cmd, stderr=subprocess.PIPE, universal_newlines=True
+
+class VideoFingerprinter:
+    # a fingerprint is the duration plus a dhash of frames at fixed positions
+    # it survives remuxing and re-encoding, unlike a hash of the file bytes
+
+    frame_positions = [0.1, 0.3, 0.5, 0.7, 0.9]
+    duration_tolerance = 1.0
+
+    def __init__(self, cache_file, threshold=8, max_workers=2):
+        # max_workers bounds how many ffmpeg processes run at once
+
+        self.threshold = threshold
+        self.max_workers = max(1, max_workers)
+        self.cache = IdentityCache(cache_file)
+
+    def get_duration(self, file_path):
+        return get_video_duration(file_path)
+
+    def get_frame_hash(self, file_path, timestamp):
+        # ffmpeg scales the frame down to 9x8 gray pixels, which is all dhash needs
+
+        import subprocess
+
+        try:
+            result = subprocess.run(
+                [
+                    "ffmpeg",
+                    "-v",
+                    "error",
+                    "-ss",
+                    f"{timestamp:.3f}",
+                    "-i",
+                    str(file_path),
+                    "-frames:v",
+                    "1",
+                    "-vf",
+                    "scale=9:8,format=gray",
+                    "-f",
+                    "rawvideo",
+                    "-",
+                ],
+                capture_output=True,
+                timeout=60,
             )
+        except Exception:
+            return None
 
-            while process.poll() is None:
-                elapsed_time = time.time() - start_time
-                if elapsed_time > timeout:
-                    process.terminate()
-                    process.wait()
+        pixels = result.stdout
+        if len(pixels) != 72:
+            return None
 
-                    conversion_success = False
-                    is_mp4 = False
-                    return
+        value = 0
+        for row in range(8):
+            for column in range(8):
+                left = pixels[row * 9 + column]
+                right = pixels[row * 9 + column + 1]
+                value = (value << 1) | int(right > left)
+
+        return value
+
+    def get_fingerprint(self, file_path):
+        duration = self.get_duration(file_path)
+        if not duration:
+            return None
+
+        hashes = list()
+        for position in self.frame_positions:
+            value = self.get_frame_hash(file_path, duration * position)
+            if value is None:
+                return None
+            hashes.append(f"{value:016x}")
+
+        return {"duration": duration, "hashes": hashes}
+
+    def get_fingerprints(self, video_paths, prune=True) -> dict:
+        from concurrent.futures import ThreadPoolExecutor
 
-            if process.returncode == 0 and self.is_valid_mp4(output_file):
-                conversion_success = True
-                is_mp4 = True
+        self.cache.load()
+
+        fingerprints = dict()
+        cache_keys = dict()
+        to_fingerprint = list()
+
+        for video_path in video_paths:
+            cache_key = self.cache.get_key(video_path)
+            if cache_key is None:
+                continue
+
+            cache_keys[video_path] = cache_key
+            if cache_key in self.cache.entries:
+                fingerprints[video_path] = self.cache.entries[cache_key]
             else:
-                conversion_success = False
-                is_mp4 = False
+                to_fingerprint.append(video_path)
+
+        if to_fingerprint:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = executor.map(self.get_fingerprint, to_fingerprint)
+                for video_path, fingerprint in tqdm(
+                    zip(to_fingerprint, results),
+                    total=len(to_fingerprint),
+                    desc="    Fingerprinting videos",
+                    unit=" videos",
+                    leave=False,
+                ):
+                    if fingerprint is None:
+                        continue
+                    fingerprints[video_path] = fingerprint
+                    self.cache.entries[cache_keys[video_path]] = fingerprint
+
+        self.cache.save(cache_keys.values(), prune)
+
+        return fingerprints
+
+    def get_distance(self, first, second) -> float:
+        distances = [
+            bin(int(first_hash, 16) ^ int(second_hash, 16)).count("1")
+            for first_hash, second_hash in zip(first["hashes"], second["hashes"])
+        ]
+        return sum(distances) / len(distances)
+
+    def find_clusters(self, video_paths, prune=True) -> list:
+        fingerprints = self.get_fingerprints(video_paths, prune)
+        return cluster_matches(fingerprints, self.get_matches(fingerprints))
+
+    def get_matches(self, fingerprints):
+        # videos are bucketed by duration, so only similar lengths are compared
+
+        buckets = dict()
+        for video_path, fingerprint in fingerprints.items():
+            bucket = int(fingerprint["duration"] // self.duration_tolerance)
+
+            for neighbour in [bucket - 1, bucket, bucket + 1]:
+                for other_path, other in buckets.get(neighbour, list()):
+                    if (
+                        abs(fingerprint["duration"] - other["duration"])
+                        <= self.duration_tolerance
+                        and self.get_distance(fingerprint, other) <= self.threshold
+                    ):
+                        yield other_path, video_path
+
+            buckets.setdefault(bucket, list()).append((video_path, fingerprint))
+
+
+class MetadataExtractor:
+    # reads only file headers: Pillow opens images lazily and never decodes pixels here
+    # videos are read with ffprobe, results are cached by file identity
+
+    def __init__(
+        self, cache_file, image_extensions, video_extensions, max_workers=8
+    ):
+        self.image_extensions = image_extensions
+        self.video_extensions = video_extensions
+        self.max_workers = max(1, max_workers)
+        self.cache = IdentityCache(cache_file)
+        self.new_count = 0
+
+    def get_image_metadata(self, file_path):
+        from PIL import Image
+
+        try:
+            with Image.open(file_path) as image:
+                metadata = {
+                    "format": image.format,
+                    "width": image.width,
+                    "height": image.height,
+                    "captured": None,
+                }
+
+                # png keeps exif after the pixel data, reading it would decode the image
+                if image.format == "PNG" and "exif" not in image.info:
+                    return metadata
+
+                exif = image.getexif()
+                captured = exif.get_ifd(0x8769).get(36867) or exif.get(306)
+
+        except Exception:
+            return None
+
+        if isinstance(captured, str) and len(captured) >= 19:
+            # exif dates look like "2020:01:31 12:00:00"
+            metadata["captured"] = (
+                captured[:10].replace(":", "-") + "T" + captured[11:19]
+            )
+
+        return metadata
+
+    def get_video_metadata(self, file_path):
+        import subprocess
+
+        try:
+            result = subprocess.run(
+                [
+                    "ffprobe",
+                    "-v",
+                    "error",
+                    "-show_entries",
+                    "format=duration:format_tags=creation_time:"
+                    "stream=codec_type,codec_name,width,height",
+                    "-of",
+                    "json",
+                    str(file_path),
+                ],
+                capture_output=True,
+                timeout=60,
+            )
+            probe = json.loads(result.stdout)
+        except Exception:
+            return None
+
+        probe_format = probe.get("format", dict())
+        metadata = {
+            "duration": float(probe_format.get("duration", 0) or 0) or None,
+            "captured": probe_format.get("tags", dict()).get("creation_time"),
+        }
 
-        thread = threading.Thread(target=conversion_thread)
+        for stream in probe.get("streams", list()):
+            if stream.get("codec_type") == "video" and "codec" not in metadata:
+                metadata["codec"] = stream.get("codec_name")
+                metadata["width"] = stream.get("width")
+                metadata["height"] = stream.get("height")
+            elif stream.get("codec_type") == "audio" and "audio_codec" not in metadata:
+                metadata["audio_codec"] = stream.get("codec_name")
 
-        thread.start()
-        thread.join()
+        return metadata
 
-        self.conversion_success = conversion_success
-        self.is_mp4 = is_mp4
+    def get_file_metadata(self, file_path):
+        suffix = Path(file_path).suffix.lower()
+
+        if suffix in self.image_extensions:
+            metadata = self.get_image_metadata(file_path)
+        elif suffix in self.video_extensions:
+            metadata = self.get_video_metadata(file_path)
+        else:
+            metadata = dict()
+
+        if metadata is None:
+            return None
+
+        try:
+            metadata["size"] = os.stat(file_path).st_size
+        except OSError:
+            return None
+
+        return metadata
+
+    def get_metadata(self, file_paths, prune=True) -> dict:
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.cache.load()
+
+        metadata = dict()
+        cache_keys = dict()
+        to_read = list()
+
+        for file_path in file_paths:
+            cache_key = self.cache.get_key(file_path)
+            if cache_key is None:
+                continue
+
+            cache_keys[file_path] = cache_key
+            if cache_key in self.cache.entries:
+                metadata[file_path] = self.cache.entries[cache_key]
+            else:
+                to_read.append(file_path)
+
+        if to_read:
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                results = executor.map(self.get_file_metadata, to_read)
+                for file_path, file_metadata in tqdm(
+                    zip(to_read, results),
+                    total=len(to_read),
+                    desc="    Reading metadata",
+                    unit=" files",
+                    leave=False,
+                ):
+                    if file_metadata is None:
+                        continue
+                    metadata[file_path] = file_metadata
+                    self.cache.entries[cache_keys[file_path]] = file_metadata
+                    self.new_count += 1
+
+        self.cache.save(cache_keys.values(), prune)
+
+        return metadata
+
+
+class ThumbnailGenerator:
+    # small jpegs of images and contact sheets of videos, kept in a sidecar folder
+    # thumbnails are named after the file identity, so a renamed file keeps its
+    # thumbnail and a changed file gets a new one
+
+    def __init__(self, thumbnail_dir, size=256, sheet_frames=4, max_workers=4):
+        # pillow decodes and ffmpeg run outside the gil, so threads are enough
+        # thumbnails.json maps each identity to the file and its thumbnail
+
+        self.thumbnail_dir = thumbnail_dir
+        self.size = max(16, int(size))
+        self.sheet_frames = max(1, int(sheet_frames))
+        self.max_workers = max(1, int(max_workers))
+
+        self.cache = IdentityCache(thumbnail_dir / "thumbnails.json")
+        self.cache.load()
+
+        self.executor = None
+        self.pending = list()
+        self.used_keys = set()
+        self.lock = threading.Lock()
+        self.is_cancelled = False
+        self.new_count = 0
+
+    def submit(self, file_path, is_video) -> None:
+        cache_key = self.cache.get_key(file_path)
+
+        with self.lock:
+            if cache_key is None or cache_key in self.used_keys:
+                return
+            self.used_keys.add(cache_key)
+
+            entry = self.cache.entries.get(cache_key)
+            if entry is not None and (self.thumbnail_dir / entry["thumbnail"]).exists():
+                entry["path"] = str(file_path)
+                return
+
+            if self.executor is None:
+                from concurrent.futures import ThreadPoolExecutor
+
+                self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+            future = self.executor.submit(
+                self.create_thumbnail, str(file_path), cache_key, is_video
+            )
+            self.pending.append(future)
+
+    def cancel(self) -> None:
+        # queued thumbnails are dropped, the next run makes them
+
+        self.is_cancelled = True
+        for future in self.pending:
+            future.cancel()
+
+    def close(self, prune=True) -> None:
+        # thumbnails of files that weren't seen are removed with their entries
+        # an interrupted or resumed run hasn't seen every file, so it keeps them
+
+        for future in self.pending:
+            if not future.cancelled():
+                future.result()
+
+        self.pending = list()
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+        if prune and not self.is_cancelled:
+            used_keys = self.used_keys
+            for cache_key, entry in self.cache.entries.items():
+                if cache_key not in used_keys:
+                    thumbnail_path = self.thumbnail_dir / entry["thumbnail"]
+                    if thumbnail_path.exists():
+                        thumbnail_path.unlink()
+        else:
+            used_keys = self.cache.entries.keys()
+
+        self.cache.save(list(used_keys))
+
+    def create_thumbnail(self, file_path, cache_key, is_video) -> None:
+        name = hashlib.sha1(cache_key.encode("utf-8")).hexdigest()
+        thumbnail_name = f"{name[:2]}/{name}.jpg"
+        thumbnail_path = self.thumbnail_dir / thumbnail_name
+
+        try:
+            if is_video:
+                image = self.get_contact_sheet(file_path)
+            else:
+                image = self.get_image_thumbnail(file_path)
+
+            if image is None:
+                return
+
+            thumbnail_path.parent.mkdir(parents=True, exist_ok=True)
+            temp_path = thumbnail_path.with_name(thumbnail_path.name + ".part")
+            image.save(temp_path, "JPEG", quality=80)
+            os.replace(temp_path, thumbnail_path)
+
+        except Exception:
+            return
+
+        with self.lock:
+            self.cache.entries[cache_key] = {
+                "path": file_path,
+                "thumbnail": thumbnail_name,
+            }
+            self.new_count += 1
+
+    def get_image_thumbnail(self, file_path):
+        # draft makes jpegs decode at a fraction of their size
+        # reduce shrinks the rest cheaply before the final resize
+
+        from PIL import Image, ImageOps
+
+        with Image.open(file_path) as image:
+            image.draft("RGB", (self.size, self.size))
+
+            factor = min(image.width, image.height) // self.size
+            image = ImageOps.exif_transpose(image).convert("RGB")
+            if factor > 1:
+                image = image.reduce(factor)
+
+            image.thumbnail((self.size, self.size))
+            return image
+
+    def get_contact_sheet(self, file_path):
+        # one ffmpeg seek per frame, nothing else of the video is decoded
+
+        from PIL import Image
+
+        duration = get_video_duration(file_path)
+        if not duration:
+            return None
+
+        frames = list()
+        for position in range(self.sheet_frames):
+            frame = self.get_frame(
+                file_path, duration * (position + 0.5) / self.sheet_frames
+            )
+            if frame is not None:
+                frames.append(frame)
+
+        if not frames:
+            return None
+
+        columns = math.ceil(math.sqrt(len(frames)))
+        rows = math.ceil(len(frames) / columns)
+        frame_height = max(frame.height for frame in frames)
+
+        sheet = Image.new("RGB", (columns * self.size, rows * frame_height))
+        for position, frame in enumerate(frames):
+            row, column = divmod(position, columns)
+            sheet.paste(frame, (column * self.size, row * frame_height))
+
+        return sheet
+
+    def get_frame(self, file_path, timestamp):
+        import io
+        import subprocess
+        from PIL import Image
+
+        try:
+            result = subprocess.run(
+                [
+                    "ffmpeg",
+                    "-v",
+                    "error",
+                    "-ss",
+                    f"{timestamp:.3f}",
+                    "-i",
+                    str(file_path),
+                    "-frames:v",
+                    "1",
+                    "-vf",
+                    f"scale={self.size}:-2",
+                    "-f",
+                    "image2pipe",
+                    "-vcodec",
+                    "mjpeg",
+                    "-",
+                ],
+                capture_output=True,
+                timeout=60,
+            )
+            if not result.stdout:
+                return None
+
+            frame = Image.open(io.BytesIO(result.stdout))
+            frame.load()
+            return frame
+
+        except Exception:
+            return None
+
+
+class CompactNameList:
+    # append-only list of strings packed into one buffer
+    # each entry costs its utf-8 bytes plus an 8 byte offset, instead of a str object
+
+    __slots__ = ("data", "offsets")
+
+    def __init__(self, items=()):
+        self.data = bytearray()
+        self.offsets = array("Q", [0])
+
+        self.extend(items)
+
+    def append(self, name) -> None:
+        self.data += name.encode("utf-8", "surrogateescape")
+        self.offsets.append(len(self.data))
+
+    def extend(self, items) -> None:
+        for item in items:
+            self.append(item)
+
+    def __len__(self) -> int:
+        return len(self.offsets) - 1
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self[position]
+
+    def __getitem__(self, position) -> str:
+        if isinstance(position, slice):
+            return [self[index] for index in range(len(self))[position]]
+
+        position = range(len(self))[position]
+        start, end = self.offsets[position], self.offsets[position + 1]
+        return self.data[start:end].decode("utf-8", "surrogateescape")
+
+
+class CompactPathList:
+    # list of paths for in-run bookkeeping that holds millions of entries
+    # parent directories are stored once and referenced by index
+    # names are packed into a CompactNameList
+
+    __slots__ = ("directories", "directory_index", "parents", "names", "lock")
+
+    def __init__(self, items=()):
+        self.directories = list()
+        self.directory_index = dict()
+        self.parents = array("I")
+        self.names = CompactNameList()
+        self.lock = threading.Lock()
+
+        self.extend(items)
+
+    def append(self, path) -> None:
+        parent, name = os.path.split(str(path))
+
+        # appends can come from the mover threads
+        with self.lock:
+            index = self.directory_index.get(parent)
+            if index is None:
+                index = len(self.directories)
+                self.directories.append(parent)
+                self.directory_index[parent] = index
+
+            self.parents.append(index)
+            self.names.append(name)
+
+    def extend(self, items) -> None:
+        for item in items:
+            self.append(item)
+
+    def get_path(self, position) -> Path:
+        directory = self.directories[self.parents[position]]
+        return Path(os.path.join(directory, self.names[position]))
+
+    def __len__(self) -> int:
+        return len(self.parents)
+
+    def __iter__(self):
+        for position in range(len(self)):
+            yield self.get_path(position)
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            return [self.get_path(position) for position in range(len(self))[key]]
+        return self.get_path(range(len(self))[key])
+
+
+class QueryIndex:
+    # the completion index as flat arrays, with one position per file
+    # each facet keeps a value id per file and the positions of every value,
+    # so a query only visits the files of its most selective facet
+    # saved as a json header line followed by the raw arrays
+
+    version = 1
+    facets = ["model", "subfolder", "extension", "source"]
+
+    def __init__(self):
+        self.values = {facet: list() for facet in self.facets}
+        self.value_ids = {facet: dict() for facet in self.facets}
+        self.ids = {facet: array("I") for facet in self.facets}
+        self.postings = {facet: list() for facet in self.facets}
+        self.names = CompactNameList()
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def add(self, model, subfolder, name, source) -> None:
+        position = len(self.names)
+        self.names.append(name)
+
+        extension = os.path.splitext(name)[1].lower()
+        facet_values = [model, subfolder, extension, source]
+        for facet, value in zip(self.facets, facet_values):
+            value_id = self.value_ids[facet].get(value)
+            if value_id is None:
+                value_id = self.value_ids[facet][value] = len(self.values[facet])
+                self.values[facet].append(value)
+                self.postings[facet].append(array("I"))
+
+            self.ids[facet].append(value_id)
+            self.postings[facet][value_id].append(position)
+
+    def get_entry(self, position) -> tuple:
+        model = self.values["model"][self.ids["model"][position]]
+        subfolder = self.values["subfolder"][self.ids["subfolder"][position]]
+        return model, subfolder, self.names[position]
+
+    def query(self, matchers, name_matcher=None) -> list:
+        # matchers maps a facet to a function that tests one of its values
+        # returns the matching positions in index order
+
+        allowed = {
+            facet: {
+                value_id
+                for value_id, value in enumerate(self.values[facet])
+                if matcher(value)
+            }
+            for facet, matcher in matchers.items()
+        }
+
+        if allowed:
+            first = min(
+                allowed,
+                key=lambda facet: sum(
+                    len(self.postings[facet][value_id]) for value_id in allowed[facet]
+                ),
+            )
+            positions = sorted(
+                itertools.chain.from_iterable(
+                    self.postings[first][value_id] for value_id in allowed[first]
+                )
+            )
+
+            for facet, value_ids in allowed.items():
+                if facet != first:
+                    facet_ids = self.ids[facet]
+                    positions = [
+                        position
+                        for position in positions
+                        if facet_ids[position] in value_ids
+                    ]
+        else:
+            positions = range(len(self.names))
+
+        if name_matcher is not None:
+            names = self.names
+            positions = [
+                position for position in positions if name_matcher(names[position])
+            ]
+
+        return list(positions)
+
+    def save(self, index_path, source_path) -> None:
+        # the source file's identity is kept, so an index older than it is ignored
+
+        stat = os.stat(source_path)
+        header = {
+            "version": self.version,
+            "byteorder": sys.byteorder,
+            "source": [stat.st_size, stat.st_mtime_ns],
+            "count": len(self.names),
+            "values": self.values,
+        }
+
+        temp_path = index_path.with_name(index_path.name + ".part")
+        with open(temp_path, "wb") as f:
+            header_json = json.dumps(header, ensure_ascii=False)
+            f.write(header_json.encode("utf-8", "surrogateescape") + b"\n")
+
+            for facet in self.facets:
+                postings = self.postings[facet]
+                starts = itertools.accumulate(map(len, postings), initial=0)
+
+                self.ids[facet].tofile(f)
+                array("Q", starts).tofile(f)
+                for posting in postings:
+                    posting.tofile(f)
+
+            self.names.offsets.tofile(f)
+            f.write(self.names.data)
+
+        os.replace(temp_path, index_path)
+
+    @classmethod
+    def load(cls, index_path, source_path):
+        # returns None when there is no index or it doesn't match the source file
+
+        try:
+            stat = os.stat(source_path)
+            f = open(index_path, "rb")
+        except OSError:
+            return None
+
+        with f:
+            header = json.loads(f.readline().decode("utf-8", "surrogateescape"))
+            if (
+                header.get("version") != cls.version
+                or header.get("byteorder") != sys.byteorder
+                or header.get("source") != [stat.st_size, stat.st_mtime_ns]
+            ):
+                return None
+
+            index = cls()
+            count = header["count"]
+
+            for facet in cls.facets:
+                index.values[facet] = header["values"][facet]
+
+                index.ids[facet] = array("I")
+                index.ids[facet].fromfile(f, count)
+
+                starts = array("Q")
+                starts.fromfile(f, len(index.values[facet]) + 1)
+
+                positions = array("I")
+                positions.fromfile(f, count)
+                index.postings[facet] = [
+                    positions[start:end] for start, end in zip(starts, starts[1:])
+                ]
+
+            index.names.offsets = array("Q")
+            index.names.offsets.fromfile(f, count + 1)
+            index.names.data = bytearray(f.read(index.names.offsets[-1]))
+
+        return index
+
+
+class History:
+    def __init__(self, history_file):
+        # the history file is only read when there is something new to save
+        # so runs that move nothing never parse it
+
+        self.history_file = history_file
+        self.history = None
+        self.new_entries = dict()
+        self.unsaved_keys = list()
+
+    def append_to_history(self, input_path, output_path):
+        timestamp = datetime.datetime.now().timestamp()
+        identifier = uuid.uuid4()
+
+        entry = {
+            "input_path": str(input_path),
+            "output_path": str(output_path),
+            "timestamp": str(timestamp),
+        }
+
+        self.new_entries[str(identifier)] = entry
+        self.unsaved_keys.append(str(identifier))
+
+    def append_batch_to_history(self, directory, renames):
+        # one entry for all names changed inside a directory
+        # renames maps each old name to its new name
+
+        timestamp = datetime.datetime.now().timestamp()
+        identifier = uuid.uuid4()
+
+        entry = {
+            "directory": str(directory),
+            "renames": dict(renames),
+            "timestamp": str(timestamp),
+        }
+
+        self.new_entries[str(identifier)] = entry
+        self.unsaved_keys.append(str(identifier))
+
+    def load_history(self):
+        if self.history_file.exists():
+            with open(self.history_file, "r") as f:
+                file_content = f.read()
+                if file_content:
+                    return json.loads(file_content)
+        return dict()
+
+    def save_history(self):
+        if not self.new_entries:
+            return
+
+        if self.history is None:
+            self.history = self.load_history()
+        self.history.update(self.new_entries)
+
+        self.backup_history()
+        with open(self.history_file, "w") as f:
+            json.dump(self.history, f, indent=4)
+
+        self.new_entries = dict()
+        self.unsaved_keys = list()
+
+    def backup_history(self):
+        history_file_backup = self.history_file.with_suffix(".bak")
+
+        if self.history_file.exists():
+            if not history_file_backup.exists():
+                shutil.copy(self.history_file, history_file_backup)
+            else:
+                if (
+                    self.history_file.stat().st_size
+                    > history_file_backup.stat().st_size
+                ):
+                    shutil.copy(self.history_file, history_file_backup)
+
+
+class Checkpoint:
+    def __init__(self, checkpoint_file):
+        # the checkpoint is an append-only json lines file
+        # each line holds what changed since the previous line was written
+        # a line with a model name means that model folder was fully processed
+
+        self.checkpoint_file = checkpoint_file
+        self.file = None
+        self.offsets = dict()
+
+    def load_checkpoint(self):
+        state = {
+            "completed_models": set(),
+            "history": dict(),
+            "result_dict": dict(),
+            "videos_to_convert": list(),
+            "images_to_convert": list(),
+            "files_touched": list(),
+            "images_seen": list(),
+            "videos_seen": list(),
+            "file_count": 0,
+        }
+
+        if not self.checkpoint_file.exists():
+            return state
+
+        with open(self.checkpoint_file, "r", encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # the last line can be cut short if the run was killed mid-write
+                    break
+
+                state["history"].update(record["history"])
+                state["result_dict"].update(record["results"])
+                state["videos_to_convert"].extend(record["videos_to_convert"])
+                state["images_to_convert"].extend(record["images_to_convert"])
+                state["files_touched"].extend(record["files_touched"])
+                # checkpoints written before the seen lists were kept have none
+                state["images_seen"].extend(record.get("images_seen", []))
+                state["videos_seen"].extend(record.get("videos_seen", []))
+
+                # files of an unfinished model are counted again when it is rescanned
+                if record["model"] is not None:
+                    state["completed_models"].add(record["model"])
+                    state["file_count"] = record["file_count"]
+
+        return state
+
+    def open(self, resume=False):
+        self.checkpoint_file.parent.mkdir(parents=True, exist_ok=True)
+        mode = "a" if resume and self.checkpoint_file.exists() else "w"
+        self.file = open(self.checkpoint_file, mode, encoding="utf-8")
+
+    def take_new(self, name, items) -> list:
+        # return the items appended to a list since it was last taken
+
+        offset = self.offsets.get(name, 0)
+        self.offsets[name] = len(items)
+        return items[offset:]
+
+    def write_checkpoint(self, record) -> None:
+        if self.file is None:
+            return
+
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+
+    def close(self) -> None:
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def clear(self) -> None:
+        self.close()
+        if self.checkpoint_file.exists():
+            self.checkpoint_file.unlink()
+
+
+class FileMover:
+    def __init__(self, max_workers=4, bandwidth_limit=0, verify_hash=True):
+        # moves on the same device are plain renames
+        # moves across devices are streamed copies that run on a thread pool
+        # bandwidth_limit is shared by all copies, in megabytes per second (0 disables it)
+
+        self.max_workers = max(1, int(max_workers))
+        self.bandwidth_limit = float(bandwidth_limit) * 1024 * 1024
+        self.verify_hash = verify_hash
+        self.buffer_size = 8 * 1024 * 1024
+
+        self.executor = None
+        self.pending = list()
+
+        # queued cross-device moves, so a destination is only handed out once
+        # and later stages leave a source alone while it is being copied
+        self.moving_lock = threading.Lock()
+        self.moving_inputs = set()
+        self.moving_outputs = set()
+
+        self.throttle_lock = threading.Lock()
+        self.throttle_start = None
+        self.throttle_bytes = 0
+
+    def move(
+        self, input_path: Path, output_path: Path, on_complete=None, on_exists=None
+    ) -> None:
+        # raises FileExistsError when the destination exists or is already queued
+        # on_exists is called instead when that is only found once a copy is done
+
+        input_path = Path(input_path)
+        output_path = Path(output_path)
+
+        with self.moving_lock:
+            if str(output_path) in self.moving_outputs:
+                raise FileExistsError(f"Destination is being moved to: {output_path}")
+
+            # a case-only rename on a case-insensitive filesystem is the same file
+            if output_path.exists() and not os.path.samefile(input_path, output_path):
+                raise FileExistsError(f"Destination already exists: {output_path}")
+
+            is_cross_device = self.is_cross_device(input_path, output_path)
+            if is_cross_device:
+                self.moving_inputs.add(str(input_path))
+                self.moving_outputs.add(str(output_path))
+
+        if not is_cross_device:
+            if output_path.exists():
+                # only a case-only rename gets here
+                input_path.rename(output_path)
+            else:
+                self.rename_no_clobber(input_path, output_path)
+            if on_complete:
+                on_complete(input_path, output_path)
+            return
+
+        if self.executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        future = self.executor.submit(
+            self.copy_verify_and_unlink,
+            input_path,
+            output_path,
+            on_complete,
+            on_exists,
+        )
+        self.pending.append(future)
+
+    def is_moving(self, path) -> bool:
+        with self.moving_lock:
+            return str(path) in self.moving_inputs
+
+    def is_reserved(self, path) -> bool:
+        with self.moving_lock:
+            return str(path) in self.moving_outputs
+
+    def rename_no_clobber(self, input_path: Path, output_path: Path) -> None:
+        # raises FileExistsError instead of replacing a file that appeared meanwhile
+        # renames on windows never replace, elsewhere a hard link claims the name first
+
+        if os.name == "nt":
+            os.rename(input_path, output_path)
+            return
+
+        try:
+            os.link(input_path, output_path)
+        except FileExistsError:
+            raise
+        except OSError:
+            # filesystems without hard links only get the check
+            if output_path.exists():
+                raise FileExistsError(f"Destination already exists: {output_path}")
+            os.rename(input_path, output_path)
+            return
+
+        os.unlink(input_path)
+
+    def wait(self) -> None:
+        # block until every queued cross-device move has finished
+
+        for future in self.pending:
+            future.result()
+
+        self.pending = list()
+        self.throttle_start = None
+        self.throttle_bytes = 0
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def is_cross_device(self, input_path: Path, output_path: Path) -> bool:
+        output_parent = output_path.parent
+        while not output_parent.exists() and output_parent != output_parent.parent:
+            output_parent = output_parent.parent
+
+        return os.stat(input_path).st_dev != os.stat(output_parent).st_dev
+
+    def copy_verify_and_unlink(
+        self, input_path, output_path, on_complete, on_exists=None
+    ) -> None:
+        # copy into a .part file so an interrupted copy is skipped by the crawl
+        # every copy gets its own .part name, and the copy never replaces a file
+        # the source is only removed once the copy has been verified
+
+        temp_path = output_path.with_name(f"{output_path.name}.{uuid.uuid4().hex}.part")
+
+        try:
+            self.copy_file(input_path, temp_path)
+
+            if not self.is_verified_copy(input_path, temp_path):
+                raise IOError(f"Verification failed for copy of {input_path}")
+
+            shutil.copystat(input_path, temp_path)
+            self.rename_no_clobber(temp_path, output_path)
+            input_path.unlink()
+
+        except FileExistsError as e:
+            if temp_path.exists():
+                temp_path.unlink()
+            self.release(input_path, output_path)
+            if on_exists:
+                on_exists(input_path, output_path)
+            else:
+                tqdm.write(f"Could not move {input_path} across devices: {e}\n")
+            return
+
+        except Exception as e:
+            tqdm.write(f"Could not move {input_path} across devices: {e}\n")
+            if temp_path.exists():
+                temp_path.unlink()
+            self.release(input_path, output_path)
+            return
+
+        self.release(input_path, output_path)
+        if on_complete:
+            on_complete(input_path, output_path)
+
+    def release(self, input_path, output_path) -> None:
+        with self.moving_lock:
+            self.moving_inputs.discard(str(input_path))
+            self.moving_outputs.discard(str(output_path))
+
+    def copy_file(self, input_path: Path, output_path: Path) -> int:
+        binary_flag = getattr(os, "O_BINARY", 0)
+        size = os.stat(input_path).st_size
+
+        copy_funcs = [self.copy_chunk_buffered]
+        if hasattr(os, "sendfile"):
+            copy_funcs.insert(0, self.copy_chunk_sendfile)
+        if hasattr(os, "copy_file_range"):
+            copy_funcs.insert(0, self.copy_chunk_file_range)
+
+        src = os.open(input_path, os.O_RDONLY | binary_flag)
+        try:
+            dst = os.open(
+                output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | binary_flag, 0o644
+            )
+            try:
+                offset = 0
+                while offset < size:
+                    count = min(self.buffer_size, size - offset)
+
+                    try:
+                        copied = copy_funcs[0](src, dst, offset, count)
+                    except OSError:
+                        # fall back to the next method only if nothing was copied yet
+                        if offset or len(copy_funcs) == 1:
+                            raise
+                        copy_funcs.pop(0)
+                        continue
+
+                    if copied == 0:
+                        break
+
+                    offset += copied
+                    self.throttle(copied)
+
+                os.fsync(dst)
+            finally:
+                os.close(dst)
+        finally:
+            os.close(src)
+
+        return offset
+
+    def copy_chunk_file_range(self, src, dst, offset, count) -> int:
+        return os.copy_file_range(src, dst, count, offset, offset)
+
+    def copy_chunk_sendfile(self, src, dst, offset, count) -> int:
+        os.lseek(dst, offset, os.SEEK_SET)
+        return os.sendfile(dst, src, offset, count)
+
+    def copy_chunk_buffered(self, src, dst, offset, count) -> int:
+        os.lseek(src, offset, os.SEEK_SET)
+        os.lseek(dst, offset, os.SEEK_SET)
+
+        data = memoryview(os.read(src, count))
+        written = 0
+        while written < len(data):
+            written += os.write(dst, data[written:])
+
+        return written
+
+    def is_verified_copy(self, input_path: Path, output_path: Path) -> bool:
+        if os.stat(input_path).st_size != os.stat(output_path).st_size:
+            return False
+
+        if not self.verify_hash:
+            return True
+
+        return self.get_file_hash(input_path) == self.get_file_hash(output_path)
+
+    def get_file_hash(self, file_path: Path) -> str:
+        file_hash = hashlib.blake2b()
+        with open(file_path, "rb") as f:
+            for chunk in iter(partial(f.read, self.buffer_size), b""):
+                file_hash.update(chunk)
+
+        return file_hash.hexdigest()
+
+    def throttle(self, num_bytes) -> None:
+        if not self.bandwidth_limit:
+            return
+
+        with self.throttle_lock:
+            now = time.monotonic()
+            if self.throttle_start is None:
+                self.throttle_start = now
+
+            self.throttle_bytes += num_bytes
+            delay = self.throttle_start + self.throttle_bytes / self.bandwidth_limit - now
+
+        if delay > 0:
+            time.sleep(delay)
+
+
+class ArchiveImporter:
+    # zip is read with zipfile, 7z and rar through the extractor's stdout
+    archive_extensions = [".zip", ".7z", ".rar"]
+
+    def __init__(
+        self, max_workers=2, max_member_size=0, max_total_size=0, extractor="7z"
+    ):
+        # members are streamed straight to their destination, there is no temp folder
+        # archives are imported on a thread pool, the members of one archive in order
+        # sizes are in megabytes per member and per archive (0 disables the limit)
+
+        self.max_workers = max(1, int(max_workers))
+        self.max_member_size = int(float(max_member_size) * 1024 * 1024)
+        self.max_total_size = int(float(max_total_size) * 1024 * 1024)
+        self.extractor = extractor
+        self.buffer_size = 1024 * 1024
+
+        self.executor = None
+        self.pending = list()
+        self.output_lock = threading.Lock()
+
+    def submit(self, archive_path, get_output_path, on_extracted, on_complete):
+        # get_output_path(name, size, crc) returns None for members to skip
+        # on_extracted(member_path, output_path) runs for every member written
+        # on_complete(archive_path, is_imported) runs once the archive is done with
+        # is_imported is False when it failed or stopped at the size limit
+
+        if self.executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+
+            self.executor = ThreadPoolExecutor(max_workers=self.max_workers)
+
+        future = self.executor.submit(
+            self.import_archive,
+            Path(archive_path),
+            get_output_path,
+            on_extracted,
+            on_complete,
+        )
+        self.pending.append(future)
+
+    def wait(self) -> None:
+        for future in self.pending:
+            future.result()
+
+        self.pending = list()
+
+        if self.executor is not None:
+            self.executor.shutdown(wait=True)
+            self.executor = None
+
+    def import_archive(
+        self, archive_path, get_output_path, on_extracted, on_complete
+    ) -> None:
+        total_size = 0
+        is_imported = False
+
+        try:
+            if archive_path.suffix.lower() == ".zip":
+                members = self.read_zip_members(archive_path)
+            else:
+                members = self.read_extractor_members(archive_path)
+
+            for name, size, crc, chunks in members:
+                if self.max_member_size and size > self.max_member_size:
+                    tqdm.write(f"Skipping {archive_path / name}, it is too large\n")
+                    continue
+
+                if self.max_total_size and total_size + size > self.max_total_size:
+                    tqdm.write(f"Stopped importing {archive_path} at the size limit\n")
+                    return
+
+                output_path = get_output_path(name, size, crc)
+                if output_path is None:
+                    continue
+
+                output_path = self.write_member(
+                    name, size, crc, chunks, output_path, get_output_path
+                )
+                if output_path is not None:
+                    total_size += size
+                    on_extracted(archive_path / name, output_path)
+
+            is_imported = True
+
+        except Exception as e:
+            tqdm.write(f"Could not import {archive_path}: {e}\n")
+
+        finally:
+            on_complete(archive_path, is_imported)
+
+    def write_member(self, name, size, crc, chunks, output_path, get_output_path):
+        # written to a .part file first, which the crawl skips
+        # the destination is checked again when done, another archive may have taken it
+
+        import zlib
+
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        temp_path = output_path.with_name(f"{output_path.name}.{uuid.uuid4().hex}.part")
+
+        try:
+            written_crc = 0
+            with open(temp_path, "wb") as f:
+                for chunk in chunks:
+                    written_crc = zlib.crc32(chunk, written_crc)
+                    f.write(chunk)
+
+            if crc is not None and written_crc != crc:
+                raise IOError(f"CRC mismatch for {name}")
+
+            with self.output_lock:
+                output_path = get_output_path(name, size, crc)
+                if output_path is None:
+                    temp_path.unlink()
+                    return None
+                os.replace(temp_path, output_path)
+
+        except BaseException:
+            if temp_path.exists():
+                temp_path.unlink()
+            raise
+
+        return output_path
+
+    def read_zip_members(self, archive_path):
+        import zipfile
+
+        with zipfile.ZipFile(archive_path) as archive:
+            for info in archive.infolist():
+                if info.is_dir():
+                    continue
+
+                with archive.open(info) as member:
+                    chunks = self.read_chunks(member, info.file_size)
+                    yield info.filename, info.file_size, info.CRC, chunks
+
+    def read_extractor_members(self, archive_path):
+        # "x -so" writes every file to stdout back to back, in listing order
+        # so one pass over the stream is split up by the listed sizes
+        # this decompresses solid archives once instead of once per member
+
+        import subprocess
+
+        listing = subprocess.run(
+            [self.extractor, "l", "-slt", str(archive_path)],
+            capture_output=True,
+            timeout=300,
+        )
+        if listing.returncode != 0:
+            raise IOError(f"{self.extractor} could not list the archive")
+
+        members = self.parse_extractor_listing(
+            listing.stdout.decode("utf-8", "surrogateescape")
+        )
+
+        process = subprocess.Popen(
+            [self.extractor, "x", "-so", str(archive_path)],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL,
+        )
+
+        try:
+            for name, size, crc in members:
+                chunks = self.read_chunks(process.stdout, size)
+                yield name, size, crc, chunks
+
+                # skipped members still have to be read past
+                for _ in chunks:
+                    pass
+
+        finally:
+            process.stdout.close()
+            process.kill()
+            process.wait()
+
+    def parse_extractor_listing(self, output) -> list:
+        # the technical listing has one "key = value" block per item after a dashed line
+
+        _, _, items = output.partition("\n----------\n")
+
+        members = list()
+        for block in items.split("\n\n"):
+            fields = dict(
+                line.split(" = ", 1) for line in block.splitlines() if " = " in line
+            )
+
+            if "Path" not in fields or fields.get("Folder") == "+":
+                continue
+            if "D" in fields.get("Attributes", "").split(" ")[0]:
+                continue
+
+            crc = fields.get("CRC")
+            members.append(
+                (
+                    fields["Path"].replace("\\", "/"),
+                    int(fields.get("Size") or 0),
+                    int(crc, 16) if crc else None,
+                )
+            )
+
+        return members
+
+    def read_chunks(self, stream, size):
+        remaining = size
+        while remaining > 0:
+            chunk = stream.read(min(self.buffer_size, remaining))
+            if not chunk:
+                raise IOError("The archive ended before the member did")
+
+            remaining -= len(chunk)
+            yield chunk
+
+
+class VideoConverter:
+    # codecs the mp4 container can take as they are
+    mp4_video_codecs = ["h264", "hevc", "mpeg4", "av1"]
+    mp4_audio_codecs = ["aac", "mp3", "alac"]
+
+    # text subtitles become mov_text, picture subtitles can't go into mp4
+    text_subtitle_codecs = ["mov_text", "subrip", "ass", "ssa", "webvtt", "text"]
+
+    # preset and crf go to libx264, threads is per ffmpeg job (0 lets ffmpeg decide)
+    default_profile = {
+        "preset": "veryfast",
+        "crf": 23,
+        "threads": 0,
+        "audio_bitrate": "192k",
+    }
+
+    def __init__(self, profile=None, encode_timeout=1800):
+        # remuxes get a short timeout, real encodes get encode_timeout
+
+        self.conversion_success = False
+        self.is_mp4 = False
+
+        self.profile = dict(self.default_profile, **(profile or dict()))
+        self.copy_timeout = 45
+        self.encode_timeout = encode_timeout
+
+    def run_conversion(self, cmd, output_file, timeout=None):
+        import subprocess
+
+        if timeout is None:
+            timeout = self.copy_timeout
+
+        # stderr isn't read, so it must not be a pipe or ffmpeg stalls once it fills
+        process = subprocess.Popen(
+            cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+        )
+
+        try:
+            process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            process.terminate()
+            process.wait()
+
+            self.conversion_success = False
+            self.is_mp4 = False
+            return
+
+        if process.returncode == 0 and self.is_valid_mp4(output_file):
+            self.conversion_success = True
+            self.is_mp4 = True
+        else:
+            self.conversion_success = False
+            self.is_mp4 = False
+
+    def copy(self, input_file, output_file):
+        import ffmpeg
+
+        try:
+            cmd = self.get_copy_cmd(input_file, output_file)
+            self.run_conversion(cmd, output_file)
+
+        except ffmpeg.Error as e:
+            tqdm.write(f"An error occurred during video copying of {input_file}")
+            tqdm.write(e.stderr + "\n")
+            self.conversion_success = False
+            self.is_mp4 = False
+
+    def convert(self, input_file, output_file, streams=None):
+        # with probed streams only what mp4 can't hold is encoded
+        # without them everything is encoded
+
+        import ffmpeg
+
+        try:
+            if streams:
+                stream_indexes, options = self.get_stream_plan(streams)
+            else:
+                stream_indexes, options = None, self.get_output_codec_options()
+
+            cmd = self.get_convert_cmd(input_file, output_file, options, stream_indexes)
+            self.run_conversion(cmd, output_file, self.get_timeout(options))
+
+        except ffmpeg.Error as e:
+            tqdm.write(f"An error occurred during video conversion of {input_file}")
+            tqdm.write(f"{e.stderr}\n")
+            self.conversion_success = False
+            self.is_mp4 = False
+
+    def copy_or_convert(self, input_file, output_file):
+        self.conversion_success = False
+        self.is_mp4 = False
+
+        input_file_path = Path(input_file)
+        output_file_path = Path(output_file)
+
+        ext = input_file_path.suffix.lower()[1:]
+
+        if ext in ["avi", "m4v", "mkv", "mov", "mpeg", "ts", "wmv"]:
+            streams = self.probe_streams(input_file_path)
+            if streams:
+                self.convert(input_file_path, output_file_path, streams)
+            else:
+                self.copy(input_file_path, output_file_path)
+
+            if not self.conversion_success:
+                self.convert(input_file_path, output_file_path)
+        else:
+            tqdm.write(f"Unsupported input file format: {ext}\n")
+
+    def is_valid_mp4(self, file_path):
+        import subprocess
+
+        try:
+            result = subprocess.run(
+                self.get_probe_format_cmd(file_path),
+                capture_output=True,
+            )
+            return self.is_mp4_probe_output(result.stdout)
+
+        except Exception as e:
+            tqdm.write(
+                f"An error occurred while checking the validity of the MP4 file: {e}\n"
+            )
+
+        return False
+
+    def get_copy_cmd(self, input_file, output_file):
+        import ffmpeg
+
+        input_stream = ffmpeg.input(str(input_file))
+        output_stream = ffmpeg.output(
+            input_stream, str(output_file), vcodec="copy", acodec="copy"
+        )
+        return ffmpeg.compile(output_stream, overwrite_output=True)
+
+    def get_convert_cmd(self, input_file, output_file, options, stream_indexes=None):
+        # stream_indexes maps those input streams only, else ffmpeg picks them
+
+        import ffmpeg
+
+        input_stream = ffmpeg.input(str(input_file))
+        if stream_indexes:
+            streams = [input_stream[str(index)] for index in stream_indexes]
+        else:
+            streams = [input_stream]
+
+        output_stream = ffmpeg.output(*streams, str(output_file), **options)
+        return ffmpeg.compile(output_stream, overwrite_output=True)
+
+    def get_timeout(self, options):
+        # copying streams and converting subtitles is quick, encoding is not
+
+        codecs = [
+            value
+            for key, value in options.items()
+            if key in ["vcodec", "acodec"] or key.startswith("c:")
+        ]
+        if all(codec in ["copy", "mov_text"] for codec in codecs):
+            return self.copy_timeout
+        return self.encode_timeout
+
+    def get_probe_format_cmd(self, file_path):
+        return ["ffprobe", "-v", "error", "-show_format", "-of", "json", str(file_path)]
+
+    def get_probe_streams_cmd(self, file_path):
+        return ["ffprobe", "-v", "error", "-show_streams", "-of", "json", str(file_path)]
+
+    def probe_streams(self, file_path) -> list:
+        import subprocess
+
+        try:
+            result = subprocess.run(
+                self.get_probe_streams_cmd(file_path), capture_output=True, timeout=60
+            )
+            return self.parse_probe_streams(result.stdout)
+        except Exception:
+            return list()
+
+    def parse_probe_streams(self, output) -> list:
+        # cover art shows up as a video stream, it is not the video itself
+
+        try:
+            streams = json.loads(output.decode("utf-8")).get("streams", list())
+        except ValueError:
+            return list()
+
+        return [
+            stream
+            for stream in streams
+            if not stream.get("disposition", dict()).get("attached_pic")
+        ]
+
+    def is_mp4_probe_output(self, output) -> bool:
+        json_output = json.loads(output.decode("utf-8"))
+        if "format" in json_output:
+            format_info = json_output["format"]
+            if (
+                "format_name" in format_info
+                and format_info["format_name"] == "mov,mp4,m4a,3gp,3g2,mj2"
+            ):
+                return True
+
+        return False
+
+    def get_output_codec_options(self):
+        # a full encode, for when the streams couldn't be probed or copied
+
+        options = {
+            "vcodec": "libx264",
+            "preset": self.profile["preset"],
+            "crf": self.profile["crf"],
+            "pix_fmt": "yuv420p",
+            "acodec": "aac",
+            "audio_bitrate": self.profile["audio_bitrate"],
+        }
+
+        if self.profile["threads"]:
+            options["threads"] = self.profile["threads"]
+
+        return options
+
+    def get_stream_plan(self, streams):
+        # decides for every stream if it is copied, encoded or dropped
+        # options use output stream specifiers, so c:a:1 is the second mapped audio
+
+        stream_indexes = list()
+        options = dict()
+        counts = {"v": 0, "a": 0, "s": 0}
+        is_encoding_video = False
+
+        for stream in streams:
+            codec = stream.get("codec_name")
+            codec_type = stream.get("codec_type")
+
+            if codec_type == "video":
+                specifier = f"v:{counts['v']}"
+                if codec in self.mp4_video_codecs:
+                    options[f"c:{specifier}"] = "copy"
+                else:
+                    options[f"c:{specifier}"] = "libx264"
+                    options[f"pix_fmt:{specifier}"] = "yuv420p"
+                    is_encoding_video = True
+            elif codec_type == "audio":
+                specifier = f"a:{counts['a']}"
+                if codec in self.mp4_audio_codecs:
+                    options[f"c:{specifier}"] = "copy"
+                else:
+                    options[f"c:{specifier}"] = "aac"
+                    options[f"b:{specifier}"] = self.profile["audio_bitrate"]
+            elif codec_type == "subtitle" and codec in self.text_subtitle_codecs:
+                specifier = f"s:{counts['s']}"
+                options[f"c:{specifier}"] = "mov_text"
+            else:
+                # picture subtitles, data and attachments
+                continue
+
+            stream_indexes.append(stream["index"])
+            counts[specifier[0]] += 1
+
+        if is_encoding_video:
+            options["preset"] = self.profile["preset"]
+            options["crf"] = self.profile["crf"]
+
+        if self.profile["threads"]:
+            options["threads"] = self.profile["threads"]
+
+        return stream_indexes, options
+
+    def benchmark_profiles(self, clips, profiles) -> list:
+        # encodes every clip with every profile, video always re-encoded
+
+        import tempfile
+        import subprocess
+
+        results = list()
+
+        for clip in clips:
+            clip = Path(clip)
+
+            try:
+                probe = subprocess.run(
+                    self.get_probe_format_cmd(clip), capture_output=True, timeout=60
+                )
+                duration = float(json.loads(probe.stdout)["format"]["duration"])
+            except Exception:
+                tqdm.write(f"Could not probe {clip}, skipping it\n")
+                continue
+
+            for name, profile in profiles.items():
+                converter = VideoConverter(profile, self.encode_timeout)
+                options = converter.get_output_codec_options()
+
+                with tempfile.TemporaryDirectory() as temp_dir:
+                    output_file = Path(temp_dir) / f"{clip.stem}.mp4"
+                    cmd = converter.get_convert_cmd(clip, output_file, options)
+
+                    start_time = time.perf_counter()
+                    result = subprocess.run(
+                        cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+                    )
+                    elapsed_time = time.perf_counter() - start_time
+
+                    output_size = None
+                    if result.returncode == 0 and output_file.exists():
+                        output_size = output_file.stat().st_size
+
+                results.append(
+                    {
+                        "profile": name,
+                        "clip": clip.name,
+                        "seconds": elapsed_time,
+                        "speed": duration / elapsed_time if elapsed_time else None,
+                        "input_size": clip.stat().st_size,
+                        "output_size": output_size,
+                    }
+                )
+
+        return results
+
+
+class AsyncVideoConverter(VideoConverter):
+    def __init__(
+        self, encoder_semaphore, probe_semaphore, profile=None, encode_timeout=1800
+    ):
+        # same conversions as VideoConverter, but awaitable
+        # results are returned instead of stored, since many run at once
+
+        super().__init__(profile, encode_timeout)
+        self.encoder_semaphore = encoder_semaphore
+        self.probe_semaphore = probe_semaphore
+
+    async def copy_or_convert_async(self, input_file, output_file) -> bool:
+        input_file_path = Path(input_file)
+        output_file_path = Path(output_file)
+
+        ext = input_file_path.suffix.lower()[1:]
+
+        if ext not in ["avi", "m4v", "mkv", "mov", "mpeg", "ts", "wmv"]:
+            tqdm.write(f"Unsupported input file format: {ext}\n")
+            return False
+
+        streams = await self.probe_streams_async(input_file_path)
+        if streams:
+            stream_indexes, options = self.get_stream_plan(streams)
+            cmd = self.get_convert_cmd(
+                input_file_path, output_file_path, options, stream_indexes
+            )
+            timeout = self.get_timeout(options)
+        else:
+            cmd = self.get_copy_cmd(input_file_path, output_file_path)
+            timeout = self.copy_timeout
+
+        if await self.run_conversion_async(cmd, output_file_path, timeout):
+            return True
+
+        options = self.get_output_codec_options()
+        cmd = self.get_convert_cmd(input_file_path, output_file_path, options)
+        return await self.run_conversion_async(
+            cmd, output_file_path, self.get_timeout(options)
+        )
+
+    async def probe_streams_async(self, file_path) -> list:
+        import asyncio
+
+        try:
+            async with self.probe_semaphore:
+                process = await asyncio.create_subprocess_exec(
+                    *self.get_probe_streams_cmd(file_path),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL,
+                )
+                output, _ = await process.communicate()
+        except Exception:
+            return list()
+
+        return self.parse_probe_streams(output)
+
+    async def run_conversion_async(self, cmd, output_file, timeout=None) -> bool:
+        import asyncio
+
+        if timeout is None:
+            timeout = self.copy_timeout
+
+        async with self.encoder_semaphore:
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.DEVNULL,
+                stderr=asyncio.subprocess.DEVNULL,
+            )
+
+            try:
+                await asyncio.wait_for(process.wait(), timeout)
+            except asyncio.TimeoutError:
+                process.kill()
+                await process.wait()
+                return False
+
+        if process.returncode != 0:
+            return False
+
+        return await self.is_valid_mp4_async(output_file)
+
+    async def is_valid_mp4_async(self, file_path) -> bool:
+        import asyncio
+
+        try:
+            async with self.probe_semaphore:
+                process = await asyncio.create_subprocess_exec(
+                    *self.get_probe_format_cmd(file_path),
+                    stdout=asyncio.subprocess.PIPE,
+                    stderr=asyncio.subprocess.DEVNULL,
+                )
+                output, _ = await process.communicate()
+
+            return self.is_mp4_probe_output(output)
+
+        except Exception as e:
+            tqdm.write(
+                f"An error occurred while checking the validity of the MP4 file: {e}\n"
+            )
+
+        return False
+
+
+class FileProcessor:
+    # the kinds of change in a run diff and how they are printed
+    run_diff_categories = {
+        "new": "new",
+        "moved_to_premium": "moved to premium",
+        "converted": "converted",
+        "renamed": "renamed",
+        "vanished": "vanished",
+    }
+
+    # file name patterns of the fan platforms, see get_premium_sources
+    premium_patterns = {
+        "coomer": re.compile(r"^[a-fA-F0-9]{64}$"),
+        "onlyfans_image": re.compile(r"\d+x\d+_[a-z0-9]{32}"),
+        "onlyfans_video": re.compile(r"[a-z0-9]{21}(_source|_480p|_720p|_1080p)"),
+        "ppv": re.compile(r"pay[\s_-]*per[\s_-]*view"),
+    }
+
+    def __init__(
+        self, num_processes, resume=False, is_worker=False, shard=None
+    ) -> None:
+        # a worker only runs the file stages for the process engine
+        # its results are collected as events and applied by the main process
+        # shard is (index, count), only the model folders of that shard are processed
+
+        self.num_processes = num_processes
+        self.resume = resume
+        self.events = list() if is_worker else None
+        self.event_lock = threading.Lock()
+        self.shard = shard
+
+        self.config = Config()
+        for key in self.config.config.keys():
+            setattr(self, key, self.config.get_value(key))
+
+        if self.shard is not None:
+            # every output of a shard gets its own file, so hosts never share one
+            for key in Config.path_keys:
+                if key != "root_dir" and getattr(self, key) is not None:
+                    setattr(self, key, self.get_shard_path(getattr(self, key)))
+
+        self.history_instance = History(self.history_file)
+
+        # workers read the cache, new hashes reach it through events
+        self.blacklist_hashes = IdentityCache(self.blacklist_hash_cache)
+        self.blacklist_hash_keys = set()
+        if self.blacklisted_files.hashes:
+            self.blacklist_hashes.load()
+        self.mover_instance = FileMover(
+            self.move_workers, self.move_bandwidth_limit, self.move_verify_hash
+        )
+        self.archive_importer = ArchiveImporter(
+            self.archive_workers,
+            self.archive_max_member_size,
+            self.archive_max_total_size,
+            self.archive_extractor,
+        )
+
+        # thumbnails are made by the process that applies the events
+        self.thumbnail_generator = None
+        if self.do_thumbnails and not is_worker and not self.is_dry_run:
+            self.thumbnail_generator = ThumbnailGenerator(
+                self.thumbnail_dir,
+                self.thumbnail_size,
+                self.thumbnail_sheet_frames,
+                self.thumbnail_workers,
+            )
+
+        if self.do_video_converts:
+            self.converter_instance = VideoConverter(
+                self.transcode_profiles[self.transcode_profile], self.transcode_timeout
+            )
+
+        self.progress_bar = None
+        self.file_count = 0
+        self.update_interval = 850
+
+        # result_dict is {model: {subfolder: CompactNameList}}
+        # it is only expanded to the index layout when exported
+        self.result_dict = dict()
+        self.videos_to_convert = CompactPathList()
+        self.images_to_convert = CompactPathList()
+        self.files_touched = CompactPathList()
+
+        self.checkpoint_instance = Checkpoint(self.checkpoint_file)
+        self.completed_models = set()
+
+        # where the stages of the current file moved it, None for deleted duplicates
+        # and the destinations of those moves, so the crawl doesn't index them twice
+        self.move_targets = dict()
+        self.moved_outputs = set()
+
+        self.images_seen = CompactPathList()
+        self.videos_seen = CompactPathList()
+        self.recompression_savings = dict()
+        self.run_diff_summary = None
+
+        if is_worker:
+            return
+
+        print("\n" + self.get_ascii_art() + "\n\n")
+        print(f"Version: {self.version}")
+        print(f" Author: {self.author}\n\n")
+
+        if self.output_attributes:
+            self.output_launch_attributes()
+            print()
+
+    def process_root(self) -> None:
+        start_time = time.time()
+
+        self.progress_bar = tqdm(
+            desc=f'    Crawling "{self.root_dir}"',
+            unit=" files",
+            leave=False,
+            bar_format="{l_bar} {n_fmt}{unit} ({rate_fmt}) [{elapsed}]",
+        )
+
+        if self.resume:
+            self.load_checkpoint()
+
+        if not self.is_dry_run:
+            self.checkpoint_instance.open(self.resume)
+
+        try:
+            self.crawl()
+
+            if self.do_recompress_images:
+                # images are only replaced once nothing else is moving them
+                self.archive_importer.wait()
+                self.mover_instance.wait()
+                self.recompress_images()
+
+        except BaseException:
+            if self.thumbnail_generator is not None:
+                self.thumbnail_generator.cancel()
+            raise
+
+        finally:
+            # also runs on ctrl+c, so everything moved so far can be resumed
+            # imported archives are filed by the mover, so they finish first
+            self.archive_importer.wait()
+            self.mover_instance.wait()
+            self.save_checkpoint()
+            self.checkpoint_instance.close()
+
+            if self.blacklisted_files.hashes:
+                # a resumed run skipped files, so their hashes are kept as well
+                used_keys = self.blacklist_hash_keys
+                if self.resume:
+                    used_keys = list(self.blacklist_hashes.entries)
+                self.blacklist_hashes.save(used_keys)
+
+            if self.thumbnail_generator is not None:
+                self.thumbnail_generator.close(prune=not self.resume)
+
+        self.progress_bar.close()
+
+        self.history_instance.save_history()
+
+        # the last index stands in for the key file the first time
+        if (
+            self.do_run_diff
+            and not self.previous_index.exists()
+            and self.completion_json.exists()
+        ):
+            self.write_index_keys(
+                self.previous_index, self.load_result_dict(self.completion_json)
+            )
+
+        self.export_result_dict(str(self.completion_json), self.result_dict)
+
+        # a dry run never wrote to the checkpoint, so an interrupted run can resume
+        if not self.is_dry_run:
+            self.checkpoint_instance.clear()
+
+        if self.do_run_diff:
+            self.update_previous_index()
+
+        total_time = time.time() - start_time
+
+        if len(self.files_touched) > 0:
+            print()
+        print("-----------------------------------\n\n")
+        print(f"Total time: {total_time:.2f} seconds")
+        print(f"Total files: {self.file_count}")
+        if self.thumbnail_generator is not None:
+            print(f"New thumbnails: {self.thumbnail_generator.new_count}")
+        print("\n")
+
+        if self.do_run_diff:
+            self.output_run_diff_summary(self.run_diff_summary)
+            print()
+
+        leftovers = dict()
+        if self.videos_to_convert:
+            leftovers["videos"] = self.group_conversion_leftovers(self.videos_to_convert)
+        if self.images_to_convert:
+            leftovers["images"] = self.group_conversion_leftovers(self.images_to_convert)
+
+        for position, (item_type, groups) in enumerate(leftovers.items()):
+            if position:
+                print()
+            self.output_conversion_leftovers(groups, item_type)
+
+        if leftovers and self.leftovers_report:
+            self.export_conversion_leftovers(self.leftovers_report, leftovers)
+            print()
+            print(f"Leftovers report: {self.leftovers_report}")
+
+        if self.do_recompress_images:
+            if leftovers:
+                print()
+            self.output_recompression_savings(self.recompression_savings)
+
+        if self.do_find_similar_images:
+            if leftovers or self.do_recompress_images:
+                print()
+            self.find_similar_images()
+
+        if self.do_find_duplicate_videos:
+            if leftovers or self.do_recompress_images or self.do_find_similar_images:
+                print()
+            self.find_duplicate_videos()
+
+        if self.do_extract_metadata:
+            print()
+            self.export_metadata_index()
+
+        print()
+        input("Press any key to exit...")
+        print()
+
+    def crawl(self) -> None:
+        partial_process_file = partial(self.process_file)
+        self.process_directory(self.root_dir, partial_process_file)
+
+    def process_file(self, file_path) -> None:
+        if self.do_converts:
+            self._process_image_converts(file_path)
+
+        if self.do_video_converts:
+            self._process_video_converts(file_path)
+
+        if self.do_renames:
+            self._process_clean_duplicate_extensions(file_path)
+
+        if self.do_imports:
+            # a submitted archive is filed and indexed once its import is done
+            if self._process_archive_imports(file_path):
+                return
+
+            self._process_premium_file_imports(file_path)
+            self._process_loose_file_imports(file_path)
+
+        # the crawl skips a moved file at its destination, so it is finished here
+        final_path = self.take_final_path(file_path)
+        if final_path is not None:
+            self._process_conversion_leftovers(final_path)
+
+            self._process_media_seen(final_path)
+
+            # moved files are queued from their move instead
+            if final_path == Path(file_path):
+                self._process_thumbnails(final_path)
+
+        self._process_add_to_result_dict(final_path)
+
+    def emit(self, *event) -> None:
+        # every change to the results of a run is a small tuple of strings
+        # workers keep them for the main process, otherwise they apply at once
+
+        if self.events is None:
+            # the mover and importer threads emit too
+            with self.event_lock:
+                self.apply_event(event)
+        else:
+            self.events.append(event)
+
+    def take_events(self) -> list:
+        events = self.events
+        self.events = list()
+        return events
+
+    def apply_event(self, event) -> None:
+        # the only place results are changed, so applying the events of a
+        # parallel run in crawl order gives the same output as a serial run
+
+        kind = event[0]
+
+        if kind == "file":
+            # a bare file event only counts a file that isn't indexed
+            if len(event) > 1:
+                self.add_to_result_dict(*event[1:])
+            self.file_count += 1
+
+            if self.file_count % self.update_interval == 0:
+                self.progress_bar.update(self.update_interval)
+        elif kind == "moved":
+            self.history_instance.append_to_history(event[1], event[2])
+            self.files_touched.append(event[2])
+            self.queue_thumbnail(event[2])
+        elif kind == "renamed":
+            self.history_instance.append_batch_to_history(event[1], event[2])
+        elif kind == "touched":
+            self.files_touched.append(event[1])
+            self.queue_thumbnail(event[1])
+        elif kind == "thumbnail":
+            self.queue_thumbnail(event[1])
+        elif kind == "image_convert":
+            self.images_to_convert.append(event[1])
+        elif kind == "video_convert":
+            self.videos_to_convert.append(event[1])
+        elif kind == "image_seen":
+            self.images_seen.append(event[1])
+        elif kind == "video_seen":
+            self.videos_seen.append(event[1])
+        elif kind == "relocated":
+            self.moved_outputs.add(event[1])
+        elif kind == "indexed":
+            # extracted from an archive, indexed but not counted as a crawled file
+            self.add_to_result_dict(*event[1:])
+        elif kind == "blacklist_hash":
+            self.blacklist_hashes.entries[event[1]] = event[2]
+            self.blacklist_hash_keys.add(event[1])
+
+    def queue_thumbnail(self, file_path) -> None:
+        if self.thumbnail_generator is None:
+            return
+
+        suffix = Path(file_path).suffix.lower()
+        if suffix in self.image_extensions:
+            self.thumbnail_generator.submit(file_path, is_video=False)
+        elif suffix in self.video_extensions:
+            self.thumbnail_generator.submit(file_path, is_video=True)
+
+    def process_directory(self, dir_path, partial_func) -> None:
+        is_root_dir = Path(dir_path) == self.root_dir
+
+        for entry in self.list_directory(dir_path, is_root_dir):
+            if entry.is_dir():
+                if not self.should_process_directory(entry, is_root_dir):
+                    continue
+
+                self.process_directory(entry.path, partial_func)
+
+                if is_root_dir:
+                    self.save_checkpoint(entry.name)
+
+            if entry.is_file():
+                if not self.should_process_file(entry):
+                    continue
+
+                partial_func(Path(entry.path))
+
+    def list_directory(self, dir_path, is_root_dir=False) -> list:
+        # the directory is listed again only if names were lowercased
+
+        entries = self.scan_entries(dir_path, is_root_dir)
+
+        if self.do_renames and self.do_renames_lowercase:
+            if self.normalize_directory_case(dir_path, entries, is_root_dir):
+                entries = self.scan_entries(dir_path, is_root_dir)
+
+        return entries
+
+    def scan_entries(self, dir_path, is_root_dir=False) -> list:
+        entries = list(os.scandir(dir_path))
+
+        if is_root_dir and self.shard is not None:
+            entries = [entry for entry in entries if self.is_in_shard(entry.name)]
+
+        return entries
+
+    def normalize_directory_case(self, dir_path, entries, is_root_dir=False) -> bool:
+        # lowercases the file and folder names of one directory in a single pass
+        # collisions are found from the listing, so nothing is checked per file
+        # folders are renamed before they are crawled, so deeper paths are never stale
+        # model folders keep their names, they key the index and the checkpoint
+
+        name_counts = Counter(entry.name.lower() for entry in entries)
+
+        renames = dict()
+        collisions = list()
+
+        for entry in entries:
+            output_name = entry.name.lower()
+            if entry.name == output_name:
+                continue
+
+            if entry.is_dir():
+                if is_root_dir or self.is_excluded_directory(entry.name):
+                    continue
+            elif not self.should_process_file(entry):
+                continue
+
+            if name_counts[output_name] > 1:
+                collisions.append(entry)
+            else:
+                renames[entry.name] = output_name
+
+        for entry in collisions:
+            if entry.is_dir():
+                tqdm.write(f"Case collision, not renamed: {entry.path}\n")
+            else:
+                # the regular rename handles duplicates and size mismatches
+                # the directory is listed again, so the new name is crawled as usual
+                self.rename_file(entry.path, Path(dir_path) / entry.name.lower())
+                self.moved_outputs.discard(self.move_targets.pop(entry.path, None))
+
+        if self.is_dry_run:
+            for input_name, output_name in renames.items():
+                tqdm.write(" Dry run:")
+                tqdm.write(f"Original: {os.path.join(dir_path, input_name)}")
+                tqdm.write(f"     New: {os.path.join(dir_path, output_name)}\n")
+            return False
+
+        renamed = dict()
+        for input_name, output_name in renames.items():
+            input_path = os.path.join(dir_path, input_name)
+            try:
+                os.rename(input_path, os.path.join(dir_path, output_name))
+            except OSError as e:
+                tqdm.write(f"Could not rename {input_path}: {e}\n")
+                continue
+
+            renamed[input_name] = output_name
+
+        if renamed:
+            self.emit("renamed", str(dir_path), renamed)
+
+        return bool(renamed or collisions)
+
+    def is_in_shard(self, name) -> bool:
+        # rendezvous hashing, every host computes the same owner for a name
+        # adding a shard only moves the names the new shard wins
+
+        index, count = self.shard
+        scores = [
+            hashlib.blake2b(
+                f"{position}/{name.lower()}".encode("utf-8", "surrogateescape"),
+                digest_size=8,
+            ).digest()
+            for position in range(count)
+        ]
+        return scores.index(max(scores)) == index
+
+    def get_shard_path(self, path, shard=None) -> Path:
+        index, count = shard or self.shard
+        path = Path(path)
+        return path.with_name(f"{path.stem}.shard-{index}-of-{count}{path.suffix}")
+
+    def find_shard_paths(self, path) -> list:
+        # the shard files of the newest shard count, in shard order
+        # raises if one of its shards is missing
+
+        path = Path(path)
+        pattern = re.compile(
+            re.escape(path.stem) + r"\.shard-(\d+)-of-(\d+)" + re.escape(path.suffix)
+        )
+
+        shard_paths = dict()
+        for shard_path in path.parent.glob(f"{path.stem}.shard-*{path.suffix}"):
+            match = pattern.fullmatch(shard_path.name)
+            if match:
+                index, count = int(match.group(1)), int(match.group(2))
+                shard_paths.setdefault(count, dict())[index] = shard_path
+
+        if not shard_paths:
+            return list()
+
+        count = max(
+            shard_paths,
+            key=lambda count: max(
+                shard_path.stat().st_mtime for shard_path in shard_paths[count].values()
+            ),
+        )
+
+        missing = [
+            str(index) for index in range(count) if index not in shard_paths[count]
+        ]
+        if missing:
+            raise FileNotFoundError(
+                f"Missing shards {', '.join(missing)} of {count} for {path}"
+            )
+
+        return [shard_paths[count][index] for index in range(count)]
+
+    def merge_shards(self) -> None:
+        # combines the shard indexes and histories into completion_json and history_file
+        # models are ordered like a single run would list them
+
+        index_paths = self.find_shard_paths(self.completion_json)
+
+        # a shard that moved nothing has no history, every shard has an index
+        count = len(index_paths)
+        history_paths = [
+            history_path
+            for history_path in (
+                self.get_shard_path(self.history_file, (index, count))
+                for index in range(count)
+            )
+            if history_path.exists()
+        ]
+
+        merged_index = dict()
+        for index_path in index_paths:
+            merged_index.update(self.load_result_dict(index_path))
+
+        root_order = {
+            entry.name: position
+            for position, entry in enumerate(os.scandir(self.root_dir))
+        }
+        merged_index = dict(
+            sorted(
+                merged_index.items(),
+                key=lambda item: root_order.get(item[0], len(root_order)),
+            )
+        )
+        self.export_result_dict(str(self.completion_json), merged_index)
+
+        for history_path in history_paths:
+            with open(history_path, "r") as f:
+                file_content = f.read()
+                if file_content:
+                    self.history_instance.new_entries.update(json.loads(file_content))
+        self.history_instance.save_history()
+
+        print(f"Merged {len(index_paths)} index shards into {self.completion_json}")
+        print(f"Merged {len(history_paths)} history shards into {self.history_file}\n")
+
+    def is_excluded_directory(self, name, is_root_dir=False) -> bool:
+        normalized_name = os.path.normcase(name)
+        return (
+            normalized_name in self.excluded_dir_names
+            or (is_root_dir and normalized_name in self.protected_model_names)
+            or (
+                self.excluded_dir_pattern is not None
+                and self.excluded_dir_pattern.match(name) is not None
+            )
+        )
+
+    def should_process_directory(self, entry, is_root_dir=False) -> bool:
+        if is_root_dir and entry.name in self.completed_models:
+            if self.is_debug:
+                tqdm.write(f"Already completed {entry.path}\n")
+            return False
+
+        if self.is_excluded_directory(entry.name, is_root_dir):
+            if self.is_debug:
+                tqdm.write(f"Skipping {entry.path}\n")
+            return False
 
-    def copy(self, input_file, output_file):
-        import ffmpeg
+        # folders below the models are lowercased when renames are enabled
+        if self.do_renames_lowercase and (is_root_dir or not self.do_renames):
+            if entry.name != entry.name.lower():
+                tqdm.write(f"Incorrect casing: {entry.path}\n")
 
-        try:
-            input_stream = ffmpeg.input(str(input_file))
-            output_stream = ffmpeg.output(
-                input_stream, str(output_file), vcodec="copy", acodec="copy"
-            )
-            cmd = ffmpeg.compile(output_stream, overwrite_output=True)
-            self.run_conversion(cmd, output_file)
+        return True
 
-        except ffmpeg.Error as e:
-            tqdm.write(f"An error occurred during video copying of {input_file}")
-            tqdm.write(e.stderr + "\n")
-            self.conversion_success = False
-            self.is_mp4 = False
+    def should_process_file(self, entry) -> bool:
+        if ".part" in Path(entry).suffix:
+            if self.is_debug:
+                tqdm.write(f"Skipping {entry.path}\n")
+            return False
 
-    def convert(self, input_file, output_file):
-        import ffmpeg
+        # moved here by an earlier file this run, and indexed from that file
+        if entry.path in self.moved_outputs:
+            self.moved_outputs.discard(entry.path)
+            if self.is_debug:
+                tqdm.write(f"Already processed {entry.path}\n")
+            return False
 
-        try:
-            input_stream = ffmpeg.input(str(input_file))
-            output_stream = ffmpeg.output(
-                input_stream,
-                str(output_file),
-                **self.get_output_codec_options(input_file),
+        return True
+
+    def load_checkpoint(self) -> None:
+        state = self.checkpoint_instance.load_checkpoint()
+
+        self.completed_models = state["completed_models"]
+        self.history_instance.new_entries.update(state["history"])
+        for model, subfolders in state["result_dict"].items():
+            self.result_dict[model] = {
+                list_type: CompactNameList(names)
+                for list_type, names in subfolders.items()
+            }
+        # leftovers of an unfinished model are found again when it is rescanned
+        # and a model finished after an earlier resume has them twice
+        # the same goes for the media seen, the reports of the run cover every model
+        # touched files aren't found again, their moves and conversions are done
+        for key in [
+            "videos_to_convert",
+            "images_to_convert",
+            "images_seen",
+            "videos_seen",
+        ]:
+            getattr(self, key).extend(
+                item
+                for item in dict.fromkeys(state[key])
+                if self.get_model_name_from_file_path(Path(item))
+                in self.completed_models
             )
-            cmd = ffmpeg.compile(output_stream, overwrite_output=True)
-            self.run_conversion(cmd, output_file)
+        self.files_touched.extend(state["files_touched"])
+        self.file_count = state["file_count"]
+
+        # restored items are already in the checkpoint file
+        self.checkpoint_instance.take_new("videos", self.videos_to_convert)
+        self.checkpoint_instance.take_new("images", self.images_to_convert)
+        self.checkpoint_instance.take_new("touched", self.files_touched)
+        self.checkpoint_instance.take_new("images_seen", self.images_seen)
+        self.checkpoint_instance.take_new("videos_seen", self.videos_seen)
+
+        if self.completed_models:
+            print(f"Resuming, skipping {len(self.completed_models)} completed models\n")
+
+    def save_checkpoint(self, model_name=None) -> None:
+        # model_name marks that model folder as done
+        # without it only the progress made so far is recorded
+
+        history = self.history_instance.new_entries
+        new_history_keys = self.checkpoint_instance.take_new(
+            "history", self.history_instance.unsaved_keys
+        )
 
-        except ffmpeg.Error as e:
-            tqdm.write(f"An error occurred during video conversion of {input_file}")
-            tqdm.write({e.stderr} + "\n")
-            self.conversion_success = False
-            self.is_mp4 = False
+        results = dict()
+        if model_name is not None and model_name in self.result_dict:
+            results[model_name] = {
+                list_type: list(names)
+                for list_type, names in self.result_dict[model_name].items()
+            }
+
+        record = {
+            "model": model_name,
+            "file_count": self.file_count,
+            "history": {key: history[key] for key in new_history_keys},
+            "results": results,
+            "videos_to_convert": [
+                str(item)
+                for item in self.checkpoint_instance.take_new(
+                    "videos", self.videos_to_convert
+                )
+            ],
+            "images_to_convert": [
+                str(item)
+                for item in self.checkpoint_instance.take_new(
+                    "images", self.images_to_convert
+                )
+            ],
+            "files_touched": [
+                str(item)
+                for item in self.checkpoint_instance.take_new(
+                    "touched", self.files_touched
+                )
+            ],
+            "images_seen": [
+                str(item)
+                for item in self.checkpoint_instance.take_new(
+                    "images_seen", self.images_seen
+                )
+            ],
+            "videos_seen": [
+                str(item)
+                for item in self.checkpoint_instance.take_new(
+                    "videos_seen", self.videos_seen
+                )
+            ],
+        }
 
-    def copy_or_convert(self, input_file, output_file):
-        self.conversion_success = False
-        self.is_mp4 = False
+        self.checkpoint_instance.write_checkpoint(record)
 
-        input_file_path = Path(input_file)
-        output_file_path = Path(output_file)
+    def find_similar_images(self) -> None:
+        finder = SimilarImageFinder(
+            self.image_hash_cache,
+            self.similar_images_hash,
+            self.similar_images_threshold,
+            self.num_processes,
+        )
+        image_paths = self.get_media_paths(self.images_seen, self.image_extensions)
+        clusters = finder.find_clusters(
+            image_paths, prune=not self.resume and self.shard is None
+        )
 
-        ext = input_file_path.suffix.lower()[1:]
+        self.output_clusters(clusters, "Similar images", self.similar_images_report)
 
-        if ext in ["avi", "m4v", "mkv", "mov", "mpeg", "ts", "wmv"]:
-            self.copy(input_file_path, output_file_path)
-            if not self.conversion_success:
-                self.convert(input_file_path, output_file_path)
-        else:
-            tqdm.write(f"Unsupported input file format: {ext}\n")
+    def find_duplicate_videos(self) -> None:
+        fingerprinter = VideoFingerprinter(
+            self.video_fingerprint_cache,
+            self.video_fingerprint_threshold,
+            self.video_fingerprint_workers,
+        )
+        video_paths = self.get_media_paths(self.videos_seen, self.video_extensions)
+        clusters = fingerprinter.find_clusters(
+            video_paths, prune=not self.resume and self.shard is None
+        )
 
-    def is_valid_mp4(self, file_path):
-        import subprocess
+        self.output_clusters(clusters, "Duplicate videos", self.duplicate_videos_report)
 
-        try:
-            result = subprocess.run(
-                [
-                    "ffprobe",
-                    "-v",
-                    "error",
-                    "-show_format",
-                    "-of",
-                    "json",
-                    str(file_path),
-                ],
-                capture_output=True,
-            )
-            output = result.stdout.decode("utf-8")
-            json_output = json.loads(output)
-            if "format" in json_output:
-                format_info = json_output["format"]
-                if (
-                    "format_name" in format_info
-                    and format_info["format_name"] == "mov,mp4,m4a,3gp,3g2,mj2"
-                ):
-                    return True
+    def recompress_images(self) -> None:
+        # images tried before with the same settings are skipped by their identity
+        # replaced images are stored under their new identity, so they aren't tried again
 
-        except Exception as e:
-            tqdm.write(
-                f"An error occurred while checking the validity of the MP4 file: {e}\n"
-            )
+        from multiprocessing import Pool
 
-        return False
+        cache = IdentityCache(
+            self.recompress_cache,
+            prefix=(
+                f"{self.recompress_quality}:{int(self.recompress_lossless_webp)}:"
+                f"{self.recompress_min_savings}:"
+            ),
+        )
+        cache.load()
 
-    def get_output_codec_options(self, input_file):
-        ext = Path(input_file).suffix.lower()[1:]
+        image_paths = self.get_media_paths(self.images_seen, self.image_extensions)
 
-        if ext == "avi":
-            return {"vcodec": "libx264", "acodec": "aac"}
-        elif ext == "m4v":
-            return {"vcodec": "copy", "acodec": "copy"}
-        elif ext == "mkv":
-            return {"vcodec": "copy", "acodec": "copy"}
-        elif ext == "mov":
-            return {"vcodec": "copy", "acodec": "copy"}
-        elif ext == "mpeg":
-            return {"vcodec": "mpeg2video", "acodec": "copy"}
-        elif ext == "ts":
-            return {"vcodec": "copy", "acodec": "copy"}
-        elif ext == "wmv":
-            # return {"vcodec": "wmv2", "acodec": "wmav2"}
-            return {"vcodec": "libx264", "acodec": "aac"}
+        cache_keys = dict()
+        to_recompress = list()
 
-        return {}
+        for image_path in image_paths:
+            cache_key = cache.get_key(image_path)
+            if cache_key is None:
+                continue
 
+            cache_keys[image_path] = cache_key
+            if cache_key not in cache.entries:
+                to_recompress.append(
+                    (
+                        image_path,
+                        self.recompress_quality,
+                        self.recompress_lossless_webp,
+                        self.recompress_min_savings,
+                        self.is_dry_run,
+                    )
+                )
 
-class FileProcessor:
-    def __init__(self, num_processes) -> None:
-        self.num_processes = num_processes
+        savings = dict()
+        renames = dict()
+
+        if to_recompress:
+            with Pool(processes=self.num_processes) as pool:
+                # in order, so the history lists the renames like a serial run
+                results = pool.imap(recompress_image, to_recompress, chunksize=8)
+                for image_path, output_path, old_size, new_size in tqdm(
+                    results,
+                    total=len(to_recompress),
+                    desc="    Recompressing images",
+                    unit=" images",
+                    leave=False,
+                ):
+                    if new_size is None:
+                        continue
 
-        self.config = Config()
-        for key in self.config.config.keys():
-            setattr(self, key, self.config.get_value(key))
+                    if output_path is None:
+                        cache.entries[cache_keys[image_path]] = "kept"
+                        continue
 
-        self.history_instance = History(self.history_file)
+                    model = self.get_model_name_from_file_path(Path(image_path))
+                    model_savings = savings.setdefault(
+                        model, {"count": 0, "old_bytes": 0, "new_bytes": 0}
+                    )
+                    model_savings["count"] += 1
+                    model_savings["old_bytes"] += old_size
+                    model_savings["new_bytes"] += new_size
 
-        if self.do_video_converts:
-            self.converter_instance = VideoConverter()
-            self.blacklisted_files = [Path(item) for item in self.blacklisted_files]
+                    if self.is_dry_run:
+                        continue
 
-        self.progress_bar = None
-        self.file_count = 0
-        self.update_interval = 850
+                    if output_path == image_path:
+                        self.emit("touched", output_path)
+                    else:
+                        self.emit("moved", image_path, output_path)
+                        relative_path = Path(image_path).relative_to(self.root_dir)
+                        renames.setdefault(
+                            (relative_path.parts[0], relative_path.parent.name),
+                            dict(),
+                        )[relative_path.name] = Path(output_path).name
+
+                    cache_key = cache.get_key(output_path)
+                    if cache_key is not None:
+                        cache.entries[cache_key] = "recompressed"
+                        cache_keys[output_path] = cache_key
+
+        cache.save(cache_keys.values())
+
+        if renames:
+            # images that became .webp no longer need converting
+            self.images_to_convert = CompactPathList(
+                path for path in self.images_to_convert if path.exists()
+            )
 
-        self.excluded_dirs = self.protected_dirs + [
-            self.root_dir / dir for dir in self.protected_models
-        ]
+        self.rename_in_result_dict(renames)
+        self.recompression_savings = dict(sorted(savings.items()))
 
-        self.result_dict = dict()
-        self.videos_to_convert = list()
-        self.images_to_convert = list()
-        self.files_touched = list()
+    def rename_in_result_dict(self, renames) -> None:
+        # renames maps (model, subfolder) to {old name: new name}
+        # the packed name lists can't change in place, so each one is rebuilt once
 
-        print("\n" + self.get_ascii_art() + "\n\n")
-        print(f"Version: {self.version}")
-        print(f" Author: {self.author}\n\n")
+        for (model, subfolder), names in renames.items():
+            subfolders = self.result_dict.get(model)
+            if subfolders is None or subfolder not in subfolders:
+                continue
 
-        if self.output_attributes:
-            self.output_launch_attributes()
-            print()
+            subfolders[subfolder] = CompactNameList(
+                names.get(name, name) for name in subfolders[subfolder]
+            )
 
-    def process_root(self) -> None:
-        start_time = time.time()
+    def output_recompression_savings(self, savings) -> None:
+        total_count = sum(group["count"] for group in savings.values())
+        total_saved = sum(
+            group["old_bytes"] - group["new_bytes"] for group in savings.values()
+        )
 
-        self.progress_bar = tqdm(
-            desc=f'    Crawling "{self.root_dir}"',
-            unit=" files",
-            leave=False,
-            bar_format="{l_bar} {n_fmt}{unit} ({rate_fmt}) [{elapsed}]",
+        title = "Recompressible images" if self.is_dry_run else "Recompressed images"
+        amount_string = (
+            f"{title}: ({total_count} files, {self.format_bytes(total_saved)} saved)"
         )
+        print(amount_string)
+        print("-" * len(amount_string))
 
-        pool = Pool(processes=self.num_processes)
-        with pool:
-            partial_process_file = partial(self.process_file)
-            self.process_directory(self.root_dir, partial_process_file)
+        for model, group in savings.items():
+            saved = group["old_bytes"] - group["new_bytes"]
+            print(
+                f"{model}: {group['count']} files, "
+                f"{self.format_bytes(group['old_bytes'])} -> "
+                f"{self.format_bytes(group['new_bytes'])} "
+                f"({self.format_bytes(saved)} saved)"
+            )
 
-        self.progress_bar.close()
+    def export_metadata_index(self) -> None:
+        # {model: {path inside the model folder: metadata}}
 
-        self.history_instance.save_history()
-        self.export_result_dict(str(self.completion_json), self.result_dict)
+        extractor = MetadataExtractor(
+            self.metadata_cache,
+            self.image_extensions,
+            self.video_extensions,
+            self.metadata_workers,
+        )
+        file_paths = self.get_media_paths(
+            self.images_seen, self.image_extensions
+        ) + self.get_media_paths(self.videos_seen, self.video_extensions)
+        # a shard only sees its own models, the cache keeps the entries of the rest
+        metadata = extractor.get_metadata(
+            file_paths, prune=not self.resume and self.shard is None
+        )
 
-        total_time = time.time() - start_time
+        metadata_index = dict()
+        for file_path, file_metadata in metadata.items():
+            relative_path = Path(file_path).relative_to(self.root_dir)
+            model = relative_path.parts[0]
+            model_path = "/".join(relative_path.parts[1:])
+            metadata_index.setdefault(model, dict())[model_path] = file_metadata
 
-        if len(self.files_touched) > 0:
-            print()
-        print("-----------------------------------\n\n")
-        print(f"Total time: {total_time:.2f} seconds")
-        print(f"Total files: {self.file_count}\n\n")
+        metadata_index = {
+            model: dict(sorted(files.items()))
+            for model, files in sorted(metadata_index.items())
+        }
 
-        if self.videos_to_convert:
-            self.output_conversion_leftovers(self.videos_to_convert, "videos")
+        self.metadata_index.parent.mkdir(parents=True, exist_ok=True)
+        with codecs.open(
+            self.metadata_index, "w", encoding="utf-8", errors="surrogateescape"
+        ) as f:
+            json.dump(metadata_index, f, indent=4, ensure_ascii=False)
+            f.write("\n")
 
-        if self.images_to_convert:
-            if self.videos_to_convert:
-                print()
-            self.output_conversion_leftovers(self.images_to_convert, "images")
+        print(f"Metadata: {len(metadata)} files ({extractor.new_count} new)")
+        print(f"Metadata index: {self.metadata_index}")
 
-        print()
-        input("Press any key to exit...")
-        print()
+    def get_media_paths(self, media_seen, extensions) -> list:
+        # files moved during the run are only in files_touched under their new path
 
-    def process_file(self, file_path) -> None:
-        if self.do_converts:
-            self._process_image_converts(file_path)
+        media_paths = dict.fromkeys(
+            str(path)
+            for path in itertools.chain(media_seen, self.files_touched)
+            if path.suffix.lower() in extensions
+        )
+        return [path for path in media_paths if os.path.isfile(path)]
 
-        if self.do_video_converts:
-            self._process_video_converts(file_path)
+    def output_clusters(self, clusters, title, report_path) -> None:
+        # a cluster spanning several models is listed under each of them
 
-        if self.do_renames:
-            self._process_lowercase_filename(file_path)
-            self._process_clean_duplicate_extensions(file_path)
+        clusters_by_model = dict()
+        for cluster in clusters:
+            models = dict.fromkeys(
+                self.get_model_name_from_file_path(Path(path)) for path in cluster
+            )
+            for model in models:
+                clusters_by_model.setdefault(model, list()).append(cluster)
 
-        if self.do_imports:
-            self._process_premium_file_imports(file_path)
-            self._process_loose_file_imports(file_path)
+        clusters_by_model = dict(sorted(clusters_by_model.items()))
 
-        self._process_conversion_leftovers(file_path)
+        amount_string = (
+            f"{title}: ({len(clusters)} clusters, {len(clusters_by_model)} models)"
+        )
+        print(amount_string)
+        print("-" * len(amount_string))
 
-        self._process_add_to_result_dict(file_path)
+        # matches between the models of different shards can't be found
+        if self.shard is not None:
+            index, count = self.shard
+            print(f"Only the models of shard {index} of {count} were compared\n")
 
-        self.file_count += 1
+        for model, model_clusters in clusters_by_model.items():
+            print(f"{model}: {len(model_clusters)} clusters")
 
-        if self.file_count % self.update_interval == 0:
-            self.progress_bar.update(self.update_interval)
+        if report_path:
+            report_path.parent.mkdir(parents=True, exist_ok=True)
+            with codecs.open(
+                report_path, "w", encoding="utf-8", errors="surrogateescape"
+            ) as f:
+                json.dump(clusters_by_model, f, indent=4, ensure_ascii=False)
+                f.write("\n")
 
-    def process_directory(self, dir_path, partial_func) -> None:
-        for entry in os.scandir(dir_path):
-            if entry.is_dir():
-                skip_directory = False
-                for exclude_dir in self.excluded_dirs:
-                    if isinstance(exclude_dir, str):
-                        if fnmatch.fnmatch(entry.name, exclude_dir):
-                            skip_directory = True
-                            break
-                    elif isinstance(exclude_dir, Path):
-                        if entry.path.startswith(str(exclude_dir)):
-                            skip_directory = True
-                            break
-
-                if skip_directory:
-                    if self.is_debug:
-                        tqdm.write(f"Skipping {entry.path}\n")
-                    continue
+            print()
+            print(f"{title} report: {report_path}")
 
-                if self.do_renames_lowercase:
-                    if entry.name != entry.name.lower():
-                        tqdm.write(f"Incorrect casing: {entry.path}\n")
+    def benchmark_transcode_profiles(self, clips) -> None:
+        converter = VideoConverter(encode_timeout=self.transcode_timeout)
+        results = converter.benchmark_profiles(clips, self.transcode_profiles)
 
-                self.process_directory(entry.path, partial_func)
+        header = (
+            f"{'Profile':<12} {'Speed':>8} {'Time':>9} {'Size':>11} {'Ratio':>7}  Clip"
+        )
+        print(header)
+        print("-" * len(header))
 
-            if entry.is_file():
-                if ".part" in Path(entry).suffix:
-                    if self.is_debug:
-                        tqdm.write(f"Skipping {entry.path}\n")
+        for result in results:
+            speed = f"{result['speed']:.2f}x" if result["speed"] else "-"
+            if result["output_size"] is None:
+                size, ratio = "failed", "-"
+            else:
+                size = self.format_bytes(result["output_size"])
+                ratio = f"{result['output_size'] / result['input_size']:.2f}"
 
-                    continue
+            print(
+                f"{result['profile']:<12} {speed:>8} {result['seconds']:>8.1f}s "
+                f"{size:>11} {ratio:>7}  {result['clip']}"
+            )
 
-                partial_func(Path(entry.path))
+        print()
+        input("Press any key to exit...")
 
     def output_launch_attributes(self) -> None:
         attributes = vars(self)
-        exclude_keys = set(["ascii_art", "config", "exclude_dirs", "excluded_dirs"])
+        exclude_keys = set(
+            [
+                "ascii_art",
+                "config",
+                "exclude_dirs",
+                "excluded_dirs",
+                "extension_subfolders",
+                "possible_extensions",
+            ]
+        )
 
         for key, value in attributes.items():
             if key in exclude_keys:
@@ -470,32 +3698,123 @@ class FileProcessor:
         print()
         input("Press Enter to continue...")
 
-    def output_conversion_leftovers(self, items_to_convert, item_type) -> None:
-        amount_string = (
-            f"{item_type.capitalize()} to convert: ({len(items_to_convert)})"
-        )
-        print(amount_string)
-        print("-" * len(amount_string))
+    def group_conversion_leftovers(self, items_to_convert) -> dict:
+        # one pass over the leftovers, grouped by extension with counts and sizes
 
-        items_by_extension = {}
+        groups = dict()
         for item in items_to_convert:
             item_path = str(item)
             extension = os.path.splitext(item_path)[1][1:]
-            if extension not in items_by_extension:
-                items_by_extension[extension] = []
-            items_by_extension[extension].append(item_path)
 
-        sorted_items = sorted(
-            items_to_convert, key=lambda x: os.path.splitext(str(x))[-1][1:]
-        )
-        sorted_items_by_extension = dict(
-            sorted(items_by_extension.items(), key=lambda item: item[0])
+            try:
+                size = os.stat(item_path).st_size
+            except OSError:
+                size = 0
+
+            group = groups.get(extension)
+            if group is None:
+                group = groups[extension] = {
+                    "count": 0,
+                    "bytes": 0,
+                    "items": CompactNameList(),
+                    "sizes": array("Q"),
+                }
+
+            group["count"] += 1
+            group["bytes"] += size
+            group["items"].append(item_path)
+            group["sizes"].append(size)
+
+        return dict(sorted(groups.items()))
+
+    def output_conversion_leftovers(self, groups, item_type) -> None:
+        # every path is only printed when there is no report file to read them from
+
+        total_count = sum(group["count"] for group in groups.values())
+        total_bytes = sum(group["bytes"] for group in groups.values())
+
+        amount_string = (
+            f"{item_type.capitalize()} to convert: ({total_count}, "
+            f"{self.format_bytes(total_bytes)})"
         )
+        print(amount_string)
+        print("-" * len(amount_string))
 
-        for extension, items in sorted_items_by_extension.items():
-            print()
-            print(f"Extension: .{extension}")
-            [print(item_path) for item_path in sorted_items if str(item_path) in items]
+        for extension, group in groups.items():
+            if not self.leftovers_report:
+                print()
+            print(
+                f"Extension: .{extension} ({group['count']} files, "
+                f"{self.format_bytes(group['bytes'])})"
+            )
+
+            if not self.leftovers_report:
+                for item_path in group["items"]:
+                    print(item_path)
+
+    def export_conversion_leftovers(self, output_path: Path, leftovers) -> None:
+        # the format follows the report suffix: .json, .csv, anything else is text
+
+        output_path = Path(output_path)
+        report_format = output_path.suffix.lower()
+
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with codecs.open(
+            output_path, "w", encoding="utf-8", errors="surrogateescape"
+        ) as f:
+            if report_format == ".json":
+                self.write_leftovers_json(f, leftovers)
+            elif report_format == ".csv":
+                self.write_leftovers_csv(f, leftovers)
+            else:
+                self.write_leftovers_text(f, leftovers)
+
+    def write_leftovers_json(self, f, leftovers) -> None:
+        # written one extension at a time instead of building the whole document
+
+        f.write("{")
+        for type_position, (item_type, groups) in enumerate(leftovers.items()):
+            f.write(", " if type_position else "")
+            f.write(f"{json.dumps(item_type)}: {{")
+
+            for position, (extension, group) in enumerate(groups.items()):
+                f.write(", " if position else "")
+                f.write(f"{json.dumps(extension)}: ")
+                f.write(f'{{"count": {group["count"]}, "bytes": {group["bytes"]}, ')
+                f.write('"files": ')
+                f.write(json.dumps(list(group["items"]), ensure_ascii=False))
+                f.write("}")
+
+            f.write("}")
+        f.write("}\n")
+
+    def write_leftovers_csv(self, f, leftovers) -> None:
+        writer = csv.writer(f, lineterminator="\n")
+        writer.writerow(["type", "extension", "path", "bytes"])
+
+        for item_type, groups in leftovers.items():
+            for extension, group in groups.items():
+                for item_path, size in zip(group["items"], group["sizes"]):
+                    writer.writerow([item_type, extension, item_path, size])
+
+    def write_leftovers_text(self, f, leftovers) -> None:
+        for item_type, groups in leftovers.items():
+            for extension, group in groups.items():
+                f.write(
+                    f"{item_type} .{extension}: {group['count']} files, "
+                    f"{self.format_bytes(group['bytes'])}\n"
+                )
+                for item_path in group["items"]:
+                    f.write(f"{item_path}\n")
+                f.write("\n")
+
+    def format_bytes(self, num_bytes) -> str:
+        for unit in ["B", "KB", "MB", "GB", "TB"]:
+            if num_bytes < 1024 or unit == "TB":
+                break
+            num_bytes /= 1024
+
+        return f"{num_bytes:.2f} {unit}" if unit != "B" else f"{num_bytes} B"
 
     def _process_broken_file_dates(self, file_path) -> None:
         # you can delete this
@@ -564,25 +3883,35 @@ class FileProcessor:
         if not self.do_video_converts:
             return
 
-        if Path(file_path) in self.blacklisted_files:
-            return
-
         input_path = Path(file_path)
 
-        if input_path.suffix.lower() in self.convertable_video_extensions:
-            self.convert_video_to_mp4(input_path)
+        if input_path.suffix.lower() not in self.convertable_video_extensions:
+            return
 
-    def _process_lowercase_filename(self, file_path) -> None:
-        if not self.do_renames_lowercase:
+        if self.is_blacklisted(input_path):
             return
 
-        input_path = Path(file_path)
+        self.convert_video_to_mp4(input_path)
 
-        if input_path.name != input_path.name.lower():
-            output_path = input_path.parent / input_path.name.lower()
-            self.rename_file(input_path, output_path)
-            if not self.is_dry_run:
-                file_path = output_path
+    def is_blacklisted(self, file_path) -> bool:
+        # content hashes are cached by file identity, so a file is hashed only once
+
+        if self.blacklisted_files.matches_path(file_path):
+            return True
+
+        if not self.blacklisted_files.hashes:
+            return False
+
+        cache_key = self.blacklist_hashes.get_key(file_path)
+        if cache_key is None:
+            return False
+
+        file_hash = self.blacklist_hashes.entries.get(cache_key)
+        if file_hash is None:
+            file_hash = self.blacklisted_files.get_file_hash(file_path)
+
+        self.emit("blacklist_hash", cache_key, file_hash)
+        return file_hash in self.blacklisted_files.hashes
 
     def _process_clean_duplicate_extensions(self, file_path) -> None:
         if not self.do_clean_duplicate_extensions:
@@ -627,27 +3956,53 @@ class FileProcessor:
         if not self.is_dry_run:
             file_path = output_path
 
-    def _process_loose_file_imports(self, file_path) -> None:
-        if not self.do_loose_file_imports:
+    def _process_archive_imports(self, file_path) -> bool:
+        # returns True once the archive is submitted, it is left alone until then
+
+        if not self.do_archive_imports:
+            return False
+
+        archive_path = Path(file_path)
+
+        if archive_path.suffix.lower() not in ArchiveImporter.archive_extensions:
+            return False
+
+        # only archives loose in a model folder are imported, they are filed once done
+        # so an archive in a subfolder was imported by an earlier run
+        if archive_path.parent.parent != self.root_dir or not archive_path.exists():
+            return False
+
+        if self.is_dry_run:
+            tqdm.write(" Dry run:")
+            tqdm.write(f"Would import {archive_path}\n")
+            return False
+
+        model_dir = self.root_dir / self.get_model_name_from_file_path(archive_path)
+
+        self.archive_importer.submit(
+            archive_path,
+            partial(self.get_archive_member_path, model_dir),
+            self.on_archive_member_extracted,
+            self.on_archive_imported,
+        )
+        return True
+
+    def _process_loose_file_imports(self, file_path, include_archives=False) -> None:
+        # an imported archive is always filed, or the next run would import it again
+        if not self.do_loose_file_imports and not include_archives:
             return
 
+        # archives being imported are filed once the import has finished
+        if self.do_archive_imports and not include_archives:
+            if Path(file_path).suffix.lower() in ArchiveImporter.archive_extensions:
+                return
+
         model_dir = self.get_model_name_from_file_path(file_path)
         model_dir = self.root_dir / model_dir
 
-        if model_dir == file_path.parent and any(
-            file_path.suffix in filetypes for filetypes in self.valid_filetypes.values()
-        ):
-            file_extension = file_path.suffix
-            subfolder = None
-
-            for key, filetypes in self.valid_filetypes.items():
-                if file_extension in filetypes:
-                    subfolder = key
-                    break
-
-            if subfolder is None:
-                subfolder = "misc"
+        subfolder = self.extension_subfolders.get(file_path.suffix)
 
+        if model_dir == file_path.parent and subfolder is not None:
             subdir_path = model_dir / subfolder
 
             if not subdir_path.exists():
@@ -666,37 +4021,109 @@ class FileProcessor:
     def _process_conversion_leftovers(self, file_path) -> None:
         file_path = Path(file_path)
 
+        # a destination still being copied to counts, its source doesn't
+        is_present = self.is_present(file_path) or self.mover_instance.is_reserved(
+            file_path
+        )
+
         if (
-            file_path.suffix.lower() in self.valid_filetypes["images"]
+            file_path.suffix.lower() in self.image_extensions
             and file_path.suffix.lower() not in self.goal_image_extensions
-            and file_path.exists()
+            and is_present
         ):
-            self.images_to_convert.append(file_path)
+            self.emit("image_convert", str(file_path))
 
         if (
-            file_path.suffix.lower() in self.valid_filetypes["videos"]
+            file_path.suffix.lower() in self.video_extensions
             and file_path.suffix.lower() not in self.goal_video_extensions
-            and file_path.exists()
+            and is_present
         ):
-            self.videos_to_convert.append(file_path)
+            self.emit("video_convert", str(file_path))
 
-    def _process_add_to_result_dict(self, file_path) -> None:
-        file_path = Path(file_path)
+    def _process_media_seen(self, file_path) -> None:
+        suffix = Path(file_path).suffix.lower()
+
+        if (
+            self.do_find_similar_images
+            or self.do_extract_metadata
+            or self.do_recompress_images
+        ):
+            if suffix in self.image_extensions:
+                self.emit("image_seen", str(file_path))
+
+        if self.do_find_duplicate_videos or self.do_extract_metadata:
+            if suffix in self.video_extensions:
+                self.emit("video_seen", str(file_path))
+
+    def _process_thumbnails(self, file_path) -> None:
+        # files moved by an earlier stage are queued from their move instead
+
+        if not self.do_thumbnails:
+            return
+
+        if self.is_present(file_path):
+            self.emit("thumbnail", str(file_path))
+
+    def is_present(self, file_path) -> bool:
+        # a file queued for a cross-device move still exists until its copy is done
+        # but later stages have to treat it as gone already
+
+        return Path(file_path).exists() and not self.mover_instance.is_moving(file_path)
 
-        relative_path = file_path.relative_to(self.root_dir)
-        key = str(relative_path.parts[0])
-        list_type = str(relative_path.parent.name)
-        value = str(relative_path.name)
+    def take_final_path(self, file_path):
+        # where the stages moved a file, like a crawl after the run would find it
+        # None when it was deleted as a duplicate or moved into a protected folder
+        # so every engine processes and indexes a moved file exactly once
 
-        if key not in self.result_dict:
-            self.result_dict[key] = [{list_type: [value]}]
+        final_path = str(file_path)
+        while final_path in self.move_targets:
+            final_path = self.move_targets.pop(final_path)
+            if final_path is None:
+                return None
+
+        if final_path != str(file_path):
+            self.emit("relocated", final_path)
+
+        if self.get_index_entry(final_path) is None:
+            return None
+
+        return Path(final_path)
+
+    def _process_add_to_result_dict(self, final_path) -> None:
+        # final_path comes from take_final_path, a file without one is only counted
+
+        if final_path is None:
+            self.emit("file")
         else:
-            for item in self.result_dict[key]:
-                if list_type in item:
-                    item[list_type].append(value)
-                    break
-            else:
-                self.result_dict[key].append({list_type: [value]})
+            self.emit("file", *self.get_index_entry(final_path))
+
+    def get_index_entry(self, file_path):
+        # the model, subfolder and name a file is indexed under
+        # None inside protected folders, which the crawl never indexes
+
+        relative_path = Path(file_path).relative_to(self.root_dir)
+        if any(self.is_excluded_directory(part) for part in relative_path.parts[1:-1]):
+            return None
+
+        return (
+            str(relative_path.parts[0]),
+            str(relative_path.parent.name),
+            str(relative_path.name),
+        )
+
+    def add_to_result_dict(self, key, list_type, value) -> None:
+        key = sys.intern(key)
+        list_type = sys.intern(list_type)
+
+        subfolders = self.result_dict.get(key)
+        if subfolders is None:
+            subfolders = self.result_dict[key] = dict()
+
+        names = subfolders.get(list_type)
+        if names is None:
+            names = subfolders[list_type] = CompactNameList()
+
+        names.append(value)
 
     def is_valid_path(self, path: Path, expect=None) -> bool:
         path = Path(path)
@@ -732,61 +4159,45 @@ class FileProcessor:
         return is_instagram_or_twitter_file(file_path)
 
     def is_premium_file(self, file_path: Path) -> bool:
-        def is_coomer_file(file_path) -> bool:
-            pattern = r"^[a-fA-F0-9]{64}$"
-            return bool(re.match(pattern, file_path.stem))
-
-        def is_fanhouse_file(file_path) -> bool:
-            return "fanhouse" in file_path.stem.lower()
-
-        def is_fansly_file(file_path) -> bool:
-            return "fansly" in file_path.stem.lower()
-
-        def is_gumroad_file(file_path) -> bool:
-            return "gumroad" in file_path.stem.lower()
+        return any(
+            getattr(self, f"do_import_{source}")
+            for source in self.get_premium_sources(file_path)
+        )
 
-        def is_onlyfans_file(file_path) -> bool:
-            def is_image(file_path) -> bool:
-                pattern = r"\d+x\d+_[a-z0-9]{32}"
-                return (
-                    re.search(pattern, file_path.stem)
-                    and file_path.suffix.lower() in self.valid_filetypes["images"]
-                )
+    def get_premium_sources(self, file_path: Path) -> list:
+        # every fan platform whose naming the file matches, whether or not it is imported
+        # the stem is split and lowercased once, this runs for every indexed file
 
-            def is_video(file_path) -> bool:
-                pattern = r"[a-z0-9]{21}(_source|_480p|_720p|_1080p)"
-                return (
-                    re.search(pattern, file_path.stem)
-                    and file_path.suffix.lower() in self.valid_filetypes["videos"]
-                )
+        stem, suffix = os.path.splitext(os.path.basename(file_path))
+        lower_stem = stem.lower()
+        suffix = suffix.lower()
+        patterns = self.premium_patterns
 
-            return (
-                is_image(file_path)
-                or is_video(file_path)
-                or "onlyfans" in file_path.stem.lower()
+        is_onlyfans_file = (
+            "onlyfans" in lower_stem
+            or (
+                suffix in self.image_extensions
+                and patterns["onlyfans_image"].search(stem)
             )
+            or (
+                suffix in self.video_extensions
+                and patterns["onlyfans_video"].search(stem)
+            )
+        )
 
-        def is_patreon_file(file_path) -> bool:
-            return "patreon" in file_path.stem.lower()
-
-        def is_ppv_file(file_path) -> bool:
-            pattern = r"pay[\s_-]*per[\s_-]*view"
-            optional_patterns = ["ppv"]
-
-            if any(pattern in file_path.stem.lower() for pattern in optional_patterns):
-                return True
+        is_ppv_file = "ppv" in lower_stem or patterns["ppv"].search(lower_stem)
 
-            return bool(re.search(pattern, file_path.stem.lower()))
+        detectors = {
+            "coomer": patterns["coomer"].match(stem),
+            "fanhouse": "fanhouse" in lower_stem,
+            "fansly": "fansly" in lower_stem,
+            "gumroad": "gumroad" in lower_stem,
+            "onlyfans": is_onlyfans_file,
+            "patreon": "patreon" in lower_stem,
+            "ppv": is_ppv_file,
+        }
 
-        return (
-            (self.do_import_coomer and is_coomer_file(file_path))
-            or (self.do_import_fanhouse and is_fanhouse_file(file_path))
-            or (self.do_import_fansly and is_fansly_file(file_path))
-            or (self.do_import_gumroad and is_gumroad_file(file_path))
-            or (self.do_import_onlyfans and is_onlyfans_file(file_path))
-            or (self.do_import_patreon and is_patreon_file(file_path))
-            or (self.do_import_ppv and is_ppv_file(file_path))
-        )
+        return [source for source, is_source_file in detectors.items() if is_source_file]
 
     def is_duplicate_extensions(self, file_path: Path) -> bool:
         file_path = Path(file_path)
@@ -796,27 +4207,92 @@ class FileProcessor:
         parts = file_name.split(".")
         file_stem = ".".join(parts[:-1])
 
-        self.possible_extensions = (
-            self.valid_filetypes["videos"] + self.valid_filetypes["images"]
-        )
-
         for ext in self.possible_extensions:
             if ext in file_stem:
                 return True
 
         return False
 
+    def get_archive_member_path(self, model_dir, name, size, crc):
+        # members go where the loose file imports would put them
+        # returns None for unknown types and for members that were imported before
+
+        member_name = Path(name.replace("\\", "/")).name.lower()
+        subfolder = self.extension_subfolders.get(Path(member_name).suffix)
+        if not member_name or subfolder is None:
+            return None
+
+        output_path = model_dir / subfolder / member_name
+
+        # follows the names get_unique_file_path hands out, so a rerun finds them
+        unique_path = output_path
+        attempts = 0
+        while unique_path.exists():
+            if unique_path.stat().st_size == size and (
+                crc is None or self.get_file_crc(unique_path) == crc
+            ):
+                return None
+
+            attempts += 1
+            unique_path = output_path.with_name(
+                f"{output_path.stem}_duplicate_{attempts}{output_path.suffix}"
+            )
+
+        # marked before the member is written, a concurrent crawl may list it first
+        self.moved_outputs.add(str(unique_path))
+        return unique_path
+
+    def get_file_crc(self, file_path: Path) -> int:
+        import zlib
+
+        crc = 0
+        with open(file_path, "rb") as f:
+            for chunk in iter(partial(f.read, 1024 * 1024), b""):
+                crc = zlib.crc32(chunk, crc)
+        return crc
+
+    def on_archive_member_extracted(self, member_path, output_path: Path) -> None:
+        # called from an importer thread, the crawl may have listed the folder already
+
+        self.on_file_moved(member_path, output_path)
+
+        index_entry = self.get_index_entry(output_path)
+        if index_entry is not None:
+            self.emit("relocated", str(output_path))
+            self.emit("indexed", *index_entry)
+
+    def on_archive_imported(self, archive_path: Path, is_imported: bool) -> None:
+        # called from an importer thread once the archive is done with
+        # a failed archive stays where it is, so the next run tries again
+
+        if not is_imported:
+            pass
+        elif self.archive_delete_after_import:
+            archive_path.unlink()
+            self.move_targets[str(archive_path)] = None
+            tqdm.write(f"Imported and deleted {archive_path}\n")
+        else:
+            # filed like any other loose file, premium names first
+            self._process_premium_file_imports(archive_path)
+            if self.is_present(archive_path):
+                self._process_loose_file_imports(archive_path, include_archives=True)
+
+        self._process_add_to_result_dict(self.take_final_path(archive_path))
+
     def get_unique_file_path(self, file_path: Path) -> Path:
         file_name = file_path.stem.lower()
         file_ext = file_path.suffix
 
         unique_file_path = file_path
 
-        if not file_path.exists():
+        def is_taken(path) -> bool:
+            return path.exists() or self.mover_instance.is_reserved(path)
+
+        if not is_taken(file_path):
             return unique_file_path
 
         attempts = 0
-        while unique_file_path.exists():
+        while is_taken(unique_file_path):
             attempts += 1
             unique_file_path = file_path.with_name(
                 f"{file_name}_duplicate_{attempts}{file_ext}"
@@ -875,6 +4351,27 @@ class FileProcessor:
         return ascii_block
 
     def convert_video_to_mp4(self, file_path: Path) -> None:
+        input_path = Path(file_path)
+        output_path = self.prepare_video_convert(input_path)
+
+        if output_path is None:
+            return
+
+        tqdm.write(f"    Found: {input_path.name}")
+
+        self.converter_instance.copy_or_convert(input_path, output_path)
+
+        self.finish_video_convert(
+            input_path,
+            output_path,
+            self.converter_instance.conversion_success,
+            self.converter_instance.is_mp4,
+        )
+
+    def prepare_video_convert(self, file_path: Path):
+        # returns the output path when ffmpeg still has to run
+        # returns None when the file was handled here (.vid renames and dry runs)
+
         file_path = Path(file_path)
 
         input_path = file_path
@@ -889,39 +4386,39 @@ class FileProcessor:
                 tqdm.write(f"Original: {file_path.name}")
                 tqdm.write(f"     New: {output_path.name}\n")
 
-            return
+            return None
 
         if output_path.exists():
             output_path = self.get_unique_file_path(output_path)
 
-        if not self.is_dry_run:
-            tqdm.write(f"    Found: {input_path.name}")
-
-            self.converter_instance.copy_or_convert(input_path, output_path)
-
-            if self.converter_instance.conversion_success:
-                if self.converter_instance.is_mp4:
-                    tqdm.write(f" Original: {input_path}")
-                    tqdm.write(f"      New: {output_path}\n")
-                    file_path = output_path
-                    if input_path.exists():
-                        input_path.unlink()
-                        self.files_touched.append(output_path)
-                else:
-                    tqdm.write(f"Original: {input_path}")
-                    tqdm.write("     New: Failed to convert.\n")
-                    if output_path.exists():
-                        output_path.unlink()
+        if self.is_dry_run:
+            tqdm.write(" Dry run:")
+            tqdm.write(f"Original: {input_path}")
+            tqdm.write(f"     New: {output_path}\n")
+            return None
+
+        return output_path
+
+    def finish_video_convert(
+        self, input_path: Path, output_path: Path, conversion_success, is_mp4
+    ) -> None:
+        if conversion_success:
+            if is_mp4:
+                tqdm.write(f" Original: {input_path}")
+                tqdm.write(f"      New: {output_path}\n")
+                if input_path.exists():
+                    input_path.unlink()
+                    self.emit("touched", str(output_path))
             else:
                 tqdm.write(f"Original: {input_path}")
                 tqdm.write("     New: Failed to convert.\n")
                 if output_path.exists():
                     output_path.unlink()
-
         else:
-            tqdm.write(" Dry run:")
             tqdm.write(f"Original: {input_path}")
-            tqdm.write(f"     New: {output_path}\n")
+            tqdm.write("     New: Failed to convert.\n")
+            if output_path.exists():
+                output_path.unlink()
 
     def convert_image_to_jpg(self, file_path: Path) -> None:
         file_path = Path(file_path)
@@ -939,6 +4436,8 @@ class FileProcessor:
             output_path = self.get_unique_file_path(output_path)
 
             if not self.is_dry_run:
+                from PIL import Image
+
                 try:
                     image = Image.open(file_path)
 
@@ -951,7 +4450,7 @@ class FileProcessor:
                         tqdm.write(f"Original: {file_path}")
                         tqdm.write(f"     New: {output_path}\n")
                         file_path.unlink()
-                        self.files_touched.append(output_path)
+                        self.emit("touched", str(output_path))
                     else:
                         tqdm.write(input_path)
                         tqdm.write(
@@ -974,7 +4473,7 @@ class FileProcessor:
         else:
             tqdm.write("File:", file_path)
             tqdm.write("File is not a PNG or JFIF.\n")
-            self.images_to_convert.append(file_path)
+            self.emit("image_convert", str(file_path))
 
     def rename_file(self, input_path: Path, output_path: Path) -> None:
         input_path = Path(input_path)
@@ -990,21 +4489,34 @@ class FileProcessor:
                 tqdm.write(f"Invalid file path: {input_path}\n")
             return
 
+        # an earlier stage already queued this file for a cross-device move
+        if self.mover_instance.is_moving(input_path):
+            return
+
         if not self.is_dry_run:
+            # marked before the move, a concurrent crawl may list the output right away
+            is_new_mark = str(output_path) not in self.moved_outputs
+            self.moved_outputs.add(str(output_path))
             try:
-                input_path.rename(output_path)
-                self.history_instance.append_to_history(input_path, output_path)
-
-                tqdm.write(f"Original: {input_path}")
-                tqdm.write(f"     New: {output_path}\n")
-                self.files_touched.append(output_path)
+                self.mover_instance.move(
+                    input_path,
+                    output_path,
+                    self.on_file_moved,
+                    on_exists=self.rename_file,
+                )
+                self.move_targets[str(input_path)] = str(output_path)
+                is_new_mark = False
 
             except FileExistsError:
+                # a destination that is still being copied to can't be compared yet
                 input_size = input_path.stat().st_size
-                output_size = output_path.stat().st_size
+                output_size = None
+                if output_path.exists():
+                    output_size = output_path.stat().st_size
 
                 if input_size == output_size:
                     input_path.unlink()
+                    self.move_targets[str(input_path)] = None
                     tqdm.write("File already exists.")
                     tqdm.write(f"Deleted duplicate file: {input_path}\n")
                     return
@@ -1019,25 +4531,747 @@ class FileProcessor:
             except Exception as e:
                 traceback.print_exc()
                 tqdm.write(f"Could not rename {input_path}: {e}\n")
-                input("Press enter to continue...")
+                # a pool worker has no console to wait on, the run goes on
+                if self.events is None:
+                    input("Press enter to continue...")
+
+            finally:
+                # nothing was moved there, so the crawl has to index what is there
+                if is_new_mark:
+                    self.moved_outputs.discard(str(output_path))
 
         else:
             tqdm.write(" Dry run:")
             tqdm.write(f"Original: {input_path}")
             tqdm.write(f"     New: {output_path}\n")
 
+    def on_file_moved(self, input_path: Path, output_path: Path) -> None:
+        # called by the mover once a file is in place
+        # cross-device moves call this from a worker thread
+
+        tqdm.write(f"Original: {input_path}")
+        tqdm.write(f"     New: {output_path}\n")
+        self.emit("moved", str(input_path), str(output_path))
+
+    def load_result_dict(self, index_path) -> dict:
+        # reads an exported index back into the {model: {subfolder: names}} layout
+
+        with open(index_path, "r", encoding="utf-8", errors="surrogateescape") as f:
+            return {
+                model: {
+                    list_type: names
+                    for subfolder in subfolders
+                    for list_type, names in subfolder.items()
+                }
+                for model, subfolders in json.load(f).items()
+            }
+
+    def get_query_index_path(self, index_path) -> Path:
+        return Path(index_path).with_suffix(".idx")
+
+    def build_query_index(self, result_dict) -> QueryIndex:
+        # the source of a file is the first fan platform its name matches
+
+        query_index = QueryIndex()
+        for model, subfolders in result_dict.items():
+            for subfolder, names in subfolders.items():
+                for name in names:
+                    sources = self.get_premium_sources(name)
+                    source = sources[0] if sources else ""
+                    query_index.add(model, subfolder, name, source)
+
+        return query_index
+
+    def query_completion_index(self, filters, use_regex=False, count_only=False):
+        # filters is a list of (field, pattern), patterns for the same field are or-ed
+        # the binary index is rebuilt from completion_json whenever that has changed
+
+        index_path = self.get_query_index_path(self.completion_json)
+        query_index = QueryIndex.load(index_path, self.completion_json)
+        if query_index is None:
+            result_dict = self.load_result_dict(self.completion_json)
+            query_index = self.build_query_index(result_dict)
+            query_index.save(index_path, self.completion_json)
+
+        patterns = dict()
+        for field, pattern in filters:
+            if field == "extension" and not use_regex:
+                if not pattern.startswith((".", "*")):
+                    pattern = f".{pattern}"
+
+            if not use_regex:
+                pattern = fnmatch.translate(pattern)
+            patterns.setdefault(field, list()).append(f"(?:{pattern})")
+
+        matchers = dict()
+        for field, field_patterns in patterns.items():
+            regex = re.compile("|".join(field_patterns), re.IGNORECASE)
+            matchers[field] = regex.search if use_regex else regex.match
+        name_matcher = matchers.pop("name", None)
+
+        start_time = time.perf_counter()
+        positions = query_index.query(matchers, name_matcher)
+        query_time = time.perf_counter() - start_time
+
+        if count_only:
+            model_ids = query_index.ids["model"]
+            counts = Counter(model_ids[position] for position in positions)
+            for model_id, count in counts.items():
+                print(f"{query_index.values['model'][model_id]}: {count} files")
+        else:
+            for position in positions:
+                print("/".join(query_index.get_entry(position)))
+
+        print()
+        print(
+            f"{len(positions)} of {len(query_index)} files "
+            f"({query_time * 1000:.1f} ms)"
+        )
+
+    def get_index_keys(self, result_dict):
+        # (model, subfolder, name) in sorted order, sorting one subfolder at a time
+
+        for model in sorted(result_dict):
+            subfolders = result_dict[model]
+            for subfolder in sorted(subfolders):
+                for name in sorted(subfolders[subfolder]):
+                    yield model, subfolder, name
+
+    def read_index_keys(self, keys_path):
+        with open(keys_path, "r", encoding="utf-8") as f:
+            for line in f:
+                yield tuple(json.loads(line))
+
+    def write_index_keys(self, keys_path, result_dict) -> None:
+        keys_path.parent.mkdir(parents=True, exist_ok=True)
+        with open(keys_path, "w", encoding="utf-8") as f:
+            for key in self.get_index_keys(result_dict):
+                f.write(json.dumps(key) + "\n")
+
+    def merge_index_keys(self, previous_keys, current_keys, keys_file):
+        # both streams are sorted, yields (is_added, key) for keys only in one of them
+        # every key of this run is written to keys_file for the next run
+
+        previous = next(previous_keys, None)
+        current = next(current_keys, None)
+
+        while previous is not None or current is not None:
+            if current is None or (previous is not None and previous < current):
+                yield False, previous
+                previous = next(previous_keys, None)
+                continue
+
+            keys_file.write(json.dumps(current) + "\n")
+            if previous is None or current < previous:
+                yield True, current
+            else:
+                previous = next(previous_keys, None)
+            current = next(current_keys, None)
+
+    def update_previous_index(self) -> None:
+        # diffs this run's index against the keys of the last one, then replaces them
+        # keys are sorted by model first, so only one model's changes are held at a time
+
+        if not self.previous_index.exists():
+            # nothing to compare with, the keys are only written for the next run
+            self.write_index_keys(self.previous_index, self.result_dict)
+            return
+
+        temp_path = self.previous_index.with_name(self.previous_index.name + ".part")
+
+        with open(temp_path, "w", encoding="utf-8") as keys_file:
+            changes = self.merge_index_keys(
+                self.read_index_keys(self.previous_index),
+                self.get_index_keys(self.result_dict),
+                keys_file,
+            )
+            run_diff = self.iter_run_diff(changes)
+
+            if self.run_diff_report:
+                self.run_diff_summary = self.export_run_diff(
+                    self.run_diff_report, run_diff
+                )
+            else:
+                self.run_diff_summary = {
+                    model: self.count_run_diff(categories)
+                    for model, categories in run_diff
+                }
+
+        os.replace(temp_path, self.previous_index)
+
+    def iter_run_diff(self, changes):
+        # yields (model, categories) for every model with changes
+
+        for model, model_changes in itertools.groupby(
+            changes, key=lambda change: change[1][0]
+        ):
+            added = list()
+            removed = list()
+            for is_added, key in model_changes:
+                (added if is_added else removed).append(key[1:])
+
+            yield model, self.classify_model_changes(model, added, removed)
+
+    def classify_model_changes(self, model, added, removed) -> dict:
+        # added and removed are (subfolder, name) pairs of one model
+        # a removed file is matched with an added one as a rename, a move into
+        # premium or a conversion, whatever is left over is new or vanished
+
+        premium = self.premium_directory
+        convertable_extensions = (
+            self.convertable_image_extensions | self.convertable_video_extensions
+        )
+        goal_extensions = self.goal_image_extensions | self.goal_video_extensions
+
+        unmatched = Counter(added)
+
+        def take(key) -> bool:
+            if unmatched[key] > 0:
+                unmatched[key] -= 1
+                return True
+            return False
+
+        converted_names = dict()
+        for subfolder, name in added:
+            stem, suffix = os.path.splitext(name)
+            if suffix.lower() in goal_extensions:
+                key = (subfolder, stem.lower())
+                converted_names.setdefault(key, list()).append(name)
+
+        categories = {category: list() for category in self.run_diff_categories}
+
+        for subfolder, name in removed:
+            old_path = f"{subfolder}/{name}"
+            lower_name = name.lower()
+            stem, suffix = os.path.splitext(name)
+
+            if lower_name != name and take((subfolder, lower_name)):
+                categories["renamed"].append([old_path, f"{subfolder}/{lower_name}"])
+                continue
+
+            new_path = None
+
+            if subfolder != premium:
+                for premium_name in dict.fromkeys([name, lower_name]):
+                    if take((premium, premium_name)):
+                        new_path = f"{premium}/{premium_name}"
+                        break
+
+                if new_path is not None:
+                    categories["moved_to_premium"].append([old_path, new_path])
+                    continue
+
+            if suffix.lower() in convertable_extensions:
+                converted_key = (subfolder, stem.lower())
+                for converted_name in converted_names.get(converted_key, ()):
+                    if take((subfolder, converted_name)):
+                        new_path = f"{subfolder}/{converted_name}"
+                        break
+
+                if new_path is not None:
+                    categories["converted"].append([old_path, new_path])
+                    continue
+
+            # premium folders are usually protected, so the move is found on disk
+            premium_path = self.root_dir / model / premium / lower_name
+            if subfolder != premium and premium_path.is_file():
+                categories["moved_to_premium"].append(
+                    [old_path, f"{premium}/{lower_name}"]
+                )
+                continue
+
+            categories["vanished"].append(old_path)
+
+        for subfolder, name in added:
+            if take((subfolder, name)):
+                categories["new"].append(f"{subfolder}/{name}")
+
+        return {category: items for category, items in categories.items() if items}
+
+    def count_run_diff(self, categories) -> dict:
+        return {category: len(items) for category, items in categories.items()}
+
+    def export_run_diff(self, output_path: Path, run_diff) -> dict:
+        # written one model at a time, .json or plain text for anything else
+        # returns the counts for the console summary
+
+        output_path = Path(output_path)
+        is_json = output_path.suffix.lower() == ".json"
+
+        summary = dict()
+
+        output_path.parent.mkdir(parents=True, exist_ok=True)
+        with codecs.open(
+            output_path, "w", encoding="utf-8", errors="surrogateescape"
+        ) as f:
+            f.write("{" if is_json else "")
+
+            for position, (model, categories) in enumerate(run_diff):
+                summary[model] = self.count_run_diff(categories)
+
+                if is_json:
+                    f.write(", " if position else "")
+                    f.write(f"{json.dumps(model, ensure_ascii=False)}: ")
+                    f.write(json.dumps(categories, ensure_ascii=False))
+                    continue
+
+                f.write(f"{model} ({self.format_run_diff_counts(summary[model])})\n")
+                for category, items in categories.items():
+                    for item in items:
+                        item = " -> ".join(item) if isinstance(item, list) else item
+                        f.write(f"{self.run_diff_categories[category]}: {item}\n")
+                f.write("\n")
+
+            f.write("}\n" if is_json else "")
+
+        return summary
+
+    def format_run_diff_counts(self, counts) -> str:
+        return ", ".join(
+            f"{counts[category]} {label}"
+            for category, label in self.run_diff_categories.items()
+            if counts.get(category)
+        )
+
+    def output_run_diff_summary(self, summary) -> None:
+        if summary is None:
+            print("Changes since the last run: none recorded yet")
+            print("The next run is compared with this one.")
+            return
+
+        totals = Counter()
+        for counts in summary.values():
+            totals.update(counts)
+
+        amount_string = (
+            "Changes since the last run: "
+            f"({self.format_run_diff_counts(totals) or 'none'})"
+        )
+        print(amount_string)
+        print("-" * len(amount_string))
+
+        for model, counts in summary.items():
+            print(f"{model}: {self.format_run_diff_counts(counts)}")
+
+        if summary and self.run_diff_report:
+            print()
+            print(f"Run diff report: {self.run_diff_report}")
+
+    def get_model_index(self, subfolders) -> list:
+        # the index keeps one single-key dict per subfolder
+
+        return [{list_type: list(names)} for list_type, names in subfolders.items()]
+
     def export_result_dict(self, output_path: Path, result_dict=None) -> None:
+        # written one model at a time so only one model is expanded in memory
+        # the output matches json.dump(..., indent=4) of the whole index
+
+        if result_dict is None:
+            result_dict = self.result_dict
+
         with codecs.open(
             output_path, "w", encoding="utf-8", errors="surrogateescape"
         ) as f:
-            json.dump(self.result_dict, f, indent=4, ensure_ascii=False)
-            f.write("\n")
+            if not result_dict:
+                f.write("{}\n")
+            else:
+                f.write("{\n")
+                for position, (model, subfolders) in enumerate(result_dict.items()):
+                    model_json = json.dumps(
+                        {model: self.get_model_index(subfolders)},
+                        indent=4,
+                        ensure_ascii=False,
+                    )
+                    if position:
+                        f.write(",\n")
+                    f.write(model_json[2:-2])
+                f.write("\n}\n")
+
+        if self.do_query_index:
+            query_index = self.build_query_index(result_dict)
+            query_index.save(self.get_query_index_path(output_path), output_path)
+
+
+class AsyncFileProcessor(FileProcessor):
+    def __init__(self, num_processes, resume=False, shard=None) -> None:
+        # runs the same stages as FileProcessor from a single asyncio event loop
+        # ffmpeg and ffprobe run as async subprocesses
+        # blocking filesystem stages run on a thread pool, everything else stays on the loop
+
+        super().__init__(num_processes, resume=resume, shard=shard)
+
+        self.loop = None
+        self.executor = None
+        self.disk_semaphore = None
+        self.encoder_semaphore = None
+        self.probe_semaphore = None
+        self.in_flight_semaphore = None
+
+    def crawl(self) -> None:
+        import asyncio
+
+        asyncio.run(self.crawl_async())
+
+    async def crawl_async(self) -> None:
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        self.loop = asyncio.get_running_loop()
+        self.executor = ThreadPoolExecutor(max_workers=self.async_disk_limit)
+
+        self.disk_semaphore = asyncio.Semaphore(self.async_disk_limit)
+        self.encoder_semaphore = asyncio.Semaphore(self.async_encoder_limit)
+        self.probe_semaphore = asyncio.Semaphore(self.async_probe_limit)
+        self.in_flight_semaphore = asyncio.Semaphore(self.async_max_in_flight)
+
+        if self.do_video_converts:
+            self.converter_instance = AsyncVideoConverter(
+                self.encoder_semaphore,
+                self.probe_semaphore,
+                self.transcode_profiles[self.transcode_profile],
+                self.transcode_timeout,
+            )
+
+        try:
+            await self.process_directory_async(self.root_dir, list())
+        finally:
+            self.executor.shutdown(wait=True)
+
+    async def run_blocking(self, func, *args):
+        return await self.loop.run_in_executor(self.executor, partial(func, *args))
+
+    async def process_directory_async(self, dir_path, tasks) -> None:
+        # model folders are crawled concurrently
+        # a model is checkpointed once every file task under it has finished
+
+        import asyncio
+
+        is_root_dir = Path(dir_path) == self.root_dir
+
+        async with self.disk_semaphore:
+            entries = await self.run_blocking(
+                self.scan_directory, dir_path, is_root_dir
+            )
+
+        model_tasks = list()
+
+        for entry, is_dir, is_file in entries:
+            if is_dir:
+                if not self.should_process_directory(entry, is_root_dir):
+                    continue
+
+                if is_root_dir:
+                    model_tasks.append(
+                        asyncio.create_task(self.process_model_async(entry))
+                    )
+                else:
+                    await self.process_directory_async(entry.path, tasks)
+
+            if is_file:
+                if not self.should_process_file(entry):
+                    continue
+
+                # wait for a free slot so the crawl never runs far ahead of the work
+                await self.in_flight_semaphore.acquire()
+                task = asyncio.create_task(self.process_file_async(Path(entry.path)))
+                tasks.append(task)
+
+        if is_root_dir:
+            await asyncio.gather(*model_tasks)
+            await asyncio.gather(*tasks)
+
+    async def process_model_async(self, entry) -> None:
+        import asyncio
+
+        tasks = list()
+        await self.process_directory_async(entry.path, tasks)
+        await asyncio.gather(*tasks)
+        self.save_checkpoint(entry.name)
+
+    def scan_directory(self, dir_path, is_root_dir=False) -> list:
+        # is_dir and is_file can stat, so they are resolved here off the loop
+
+        return [
+            (entry, entry.is_dir(), entry.is_file())
+            for entry in self.list_directory(dir_path, is_root_dir)
+        ]
+
+    async def process_file_async(self, file_path) -> None:
+        try:
+            if self.do_converts and self.do_image_converts:
+                async with self.encoder_semaphore:
+                    await self.run_blocking(self._process_image_converts, file_path)
+
+            if self.do_video_converts:
+                await self._process_video_converts_async(file_path)
+
+            async with self.disk_semaphore:
+                final_path = await self.run_blocking(self.process_file_moves, file_path)
+
+            if final_path is False:
+                return
+
+            if final_path is not None:
+                self._process_media_seen(final_path)
+
+                # moved files are queued from their move instead
+                if final_path == Path(file_path):
+                    self._process_thumbnails(final_path)
+
+            self._process_add_to_result_dict(final_path)
+
+        finally:
+            self.in_flight_semaphore.release()
+
+    def process_file_moves(self, file_path):
+        # returns the path from take_final_path, or False for a submitted archive
+        # which is indexed once its import is done
+
+        if self.do_renames:
+            self._process_clean_duplicate_extensions(file_path)
+
+        if self.do_imports:
+            if self._process_archive_imports(file_path):
+                return False
+
+            self._process_premium_file_imports(file_path)
+            self._process_loose_file_imports(file_path)
+
+        final_path = self.take_final_path(file_path)
+        if final_path is not None:
+            self._process_conversion_leftovers(final_path)
+        return final_path
+
+    async def _process_video_converts_async(self, file_path) -> None:
+        input_path = Path(file_path)
+
+        if input_path.suffix.lower() not in self.convertable_video_extensions:
+            return
+
+        # hashing a listed file would block the loop
+        if self.blacklisted_files.hashes:
+            async with self.disk_semaphore:
+                if await self.run_blocking(self.is_blacklisted, input_path):
+                    return
+        elif self.blacklisted_files.matches_path(input_path):
+            return
+
+        async with self.disk_semaphore:
+            output_path = await self.run_blocking(
+                self.prepare_video_convert, input_path
+            )
+
+        if output_path is None:
+            return
+
+        tqdm.write(f"    Found: {input_path.name}")
+
+        conversion_success = await self.converter_instance.copy_or_convert_async(
+            input_path, output_path
+        )
+
+        async with self.disk_semaphore:
+            await self.run_blocking(
+                self.finish_video_convert,
+                input_path,
+                output_path,
+                conversion_success,
+                conversion_success,
+            )
+
+
+class ProcessFileProcessor(FileProcessor):
+    # the crawl and every result stay in this process
+    # the file stages run on a pool of worker processes in batches
+    # their events are applied in crawl order, so the output matches a serial run
+
+    batch_size = 64
+
+    def __init__(self, num_processes, resume=False, shard=None) -> None:
+        super().__init__(num_processes, resume=resume, shard=shard)
+        self.pool = None
+
+        # file paths for the workers and events of the crawl itself, in crawl order
+        self.pending = list()
+
+    def crawl(self) -> None:
+        from multiprocessing import Pool
+
+        with Pool(self.num_processes, initializer=init_file_worker) as pool:
+            self.pool = pool
+            try:
+                super().crawl()
+                self.flush_pending()
+            finally:
+                # files still pending after an interrupt are rescanned on resume
+                self.pool = None
+
+    def process_file(self, file_path) -> None:
+        self.pending.append(str(file_path))
+
+        if len(self.pending) >= self.batch_size * self.num_processes * 4:
+            self.flush_pending()
+
+    def emit(self, *event) -> None:
+        # renames done by the crawl wait behind the files queued before them
+
+        if self.pool is not None:
+            self.pending.append(event)
+        else:
+            super().emit(*event)
+
+    def flush_pending(self) -> None:
+        pending = self.pending
+        self.pending = list()
+
+        # consecutive paths become batches, events stay where they are
+        order = list()
+        for item in pending:
+            if isinstance(item, tuple):
+                order.append(item)
+            elif (
+                order
+                and isinstance(order[-1], list)
+                and len(order[-1]) < self.batch_size
+            ):
+                order[-1].append(item)
+            else:
+                order.append([item])
+
+        batches = [item for item in order if isinstance(item, list)]
+        results = self.pool.imap(process_file_batch, batches)
+
+        for item in order:
+            events = next(results) if isinstance(item, list) else [item]
+            for event in events:
+                self.apply_event(event)
+
+    def save_checkpoint(self, model_name=None) -> None:
+        # a model is only done once the events of all its files are applied
+
+        if self.pool is not None:
+            self.flush_pending()
+
+        super().save_checkpoint(model_name)
+
+
+# the FileProcessor of a worker process, set up once by init_file_worker
+file_worker = None
+
+
+def init_file_worker() -> None:
+    global file_worker
+
+    file_worker = FileProcessor(1, is_worker=True)
+
+
+def process_file_batch(file_paths) -> list:
+    for file_path in file_paths:
+        file_worker.process_file(Path(file_path))
+
+    # moves to another drive report back from the mover threads
+    file_worker.archive_importer.wait()
+    file_worker.mover_instance.wait()
+    return file_worker.take_events()
+
+
+def parse_shard(value) -> tuple:
+    match = re.fullmatch(r"(\d+)/(\d+)", value)
+    if not match or int(match.group(1)) >= int(match.group(2)):
+        raise argparse.ArgumentTypeError(
+            f"{value!r} is not a shard like 0/3, the index must be below the count"
+        )
+    return int(match.group(1)), int(match.group(2))
+
+
+def parse_query_filter(value) -> tuple:
+    field, separator, pattern = value.partition("=")
+    fields = ["model", "subfolder", "extension", "source", "name"]
+    if not separator or field not in fields:
+        raise argparse.ArgumentTypeError(
+            f"{value!r} is not a filter like extension=.ts, "
+            f"the field must be one of {', '.join(fields)}"
+        )
+    return field, pattern
 
 
 def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="continue from the last checkpoint of an interrupted run",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=["sync", "async", "process"],
+        default="sync",
+        help="async suits i/o bound libraries, process runs files on worker processes",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        metavar="INDEX/COUNT",
+        help="only process the model folders of one shard, e.g. 0/3",
+    )
+    parser.add_argument(
+        "--merge-shards",
+        action="store_true",
+        help="combine the shard indexes and histories of a sharded run",
+    )
+    parser.add_argument(
+        "--benchmark-profiles",
+        nargs="+",
+        metavar="CLIP",
+        help="encode sample clips with every transcode profile and compare them",
+    )
+    parser.add_argument(
+        "--query",
+        nargs="+",
+        type=parse_query_filter,
+        metavar="FIELD=PATTERN",
+        help="list the indexed files matching every filter, e.g. source=fansly",
+    )
+    parser.add_argument(
+        "--regex",
+        action="store_true",
+        help="read --query patterns as regular expressions instead of globs",
+    )
+    parser.add_argument(
+        "--count",
+        action="store_true",
+        help="only print how many --query matches each model has",
+    )
+    args = parser.parse_args()
+
+    if args.merge_shards and args.shard:
+        parser.error("--merge-shards combines all shards, leave out --shard")
+
+    if (args.regex or args.count) and not args.query:
+        parser.error("--regex and --count only apply to --query")
+
+    processor_class = {
+        "sync": FileProcessor,
+        "async": AsyncFileProcessor,
+        "process": ProcessFileProcessor,
+    }[args.engine]
+
     os.system("cls" if platform.system() == "Windows" else "clear")
     with CustomEnvironment():
-        processor = FileProcessor(8)
+        processor = processor_class(8, resume=args.resume, shard=args.shard)
+
+        if args.merge_shards:
+            processor.merge_shards()
+            return
+
+        if args.benchmark_profiles:
+            processor.benchmark_transcode_profiles(args.benchmark_profiles)
+            return
+
+        if args.query:
+            processor.query_completion_index(args.query, args.regex, args.count)
+            return
+
         processor.process_root()
 
 
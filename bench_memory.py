@@ -0,0 +1,136 @@
+import sys
+import json
+import argparse
+import resource
+import subprocess
+from types import SimpleNamespace
+from pathlib import Path
+
+import app
+
+# peak memory of the in-run bookkeeping on a synthetic library, no files on disk
+# every file is indexed and touched, and by default also left over for conversion
+# "before" keeps plain lists of Path and the old index layout, "after" uses the
+# compact lists app.py keeps now, each runs in a fresh interpreter
+#
+#   python bench_memory.py
+#   python bench_memory.py --files 200000 --models 500 --leftovers 20
+
+
+def get_peak_rss() -> int:
+    # ru_maxrss is in kilobytes on linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def generate_files(root: str, files: int, models: int):
+    # crawl order, one model folder at a time
+    subfolders = ["images", "images", "videos", "misc"]
+    extensions = {"images": ".jpg", "videos": ".mp4", "misc": ".txt"}
+    files_per_model = max(1, files // models)
+
+    for number in range(files):
+        model = f"Model Name {number // files_per_model:05d}"
+        subfolder = subfolders[number % len(subfolders)]
+        name = f"fansly_2023-05-01_{number:09d}{extensions[subfolder]}"
+        yield model, subfolder, name, f"{root}/{model}/{subfolder}/{name}"
+
+
+def add_to_result_dict_before(result_dict, key, list_type, value) -> None:
+    # the index layout and lookup before the compact lists
+
+    if key not in result_dict:
+        result_dict[key] = [{list_type: [value]}]
+    else:
+        for item in result_dict[key]:
+            if list_type in item:
+                item[list_type].append(value)
+                break
+        else:
+            result_dict[key].append({list_type: [value]})
+
+
+def run_before(files: int, models: int, root: str, leftovers: int) -> dict:
+    result_dict = dict()
+    files_touched = list()
+    images_to_convert = list()
+    videos_to_convert = list()
+
+    start_rss = get_peak_rss()
+    for number, (model, subfolder, name, path) in enumerate(
+        generate_files(root, files, models)
+    ):
+        add_to_result_dict_before(result_dict, model, subfolder, name)
+        files_touched.append(Path(path))
+        if number % 100 < leftovers:
+            if subfolder == "videos":
+                videos_to_convert.append(Path(path))
+            else:
+                images_to_convert.append(Path(path))
+
+    return {"growth": get_peak_rss() - start_rss}
+
+
+def run_after(files: int, models: int, root: str, leftovers: int) -> dict:
+    processor = SimpleNamespace(result_dict=dict())
+    files_touched = app.CompactPathList()
+    images_to_convert = app.CompactPathList()
+    videos_to_convert = app.CompactPathList()
+
+    start_rss = get_peak_rss()
+    for number, (model, subfolder, name, path) in enumerate(
+        generate_files(root, files, models)
+    ):
+        app.FileProcessor.add_to_result_dict(processor, model, subfolder, name)
+        files_touched.append(path)
+        if number % 100 < leftovers:
+            if subfolder == "videos":
+                videos_to_convert.append(path)
+            else:
+                images_to_convert.append(path)
+
+    return {"growth": get_peak_rss() - start_rss}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--files", type=int, default=2000000)
+    parser.add_argument("--models", type=int, default=5000)
+    parser.add_argument("--leftovers", type=int, default=100, help="percent of files")
+    parser.add_argument("--root", default="D:/Content/ISOs")
+    parser.add_argument("--mode", choices=["before", "after"])
+    args = parser.parse_args()
+
+    modes = {"before": run_before, "after": run_after}
+
+    if args.mode:
+        result = modes[args.mode](args.files, args.models, args.root, args.leftovers)
+        print(json.dumps(result))
+        return
+
+    print(f"{args.files:,} files in {args.models:,} model folders")
+    for mode in modes:
+        output = subprocess.run(
+            [
+                sys.executable,
+                __file__,
+                "--mode",
+                mode,
+                "--files",
+                str(args.files),
+                "--models",
+                str(args.models),
+                "--leftovers",
+                str(args.leftovers),
+                "--root",
+                args.root,
+            ],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout
+        result = json.loads(output)
+        print(f"  {mode}: {result['growth'] / 1024 / 1024:,.0f} MB peak RSS growth")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,313 @@
+import io
+import os
+import sys
+import json
+import shutil
+import zipfile
+import argparse
+import tempfile
+from pathlib import Path
+
+import yaml
+
+import app
+
+# runs every engine on a copy of the same generated tree and fails unless the index,
+# history, leftovers and resulting files match the default engine
+# the process engine must match exactly, the async engine finishes files out of order
+# so only its contents are compared
+# the first tree has loose files at the model roots, so files are moved during the crawl
+# the second has archives, premium named ones among them, which are imported on
+# threads in every engine, so no engine is compared in order there
+#
+#   python check_engines.py
+#   python check_engines.py --models 20 --files 200
+
+
+def build_tree(root: Path, models: int, files: int) -> None:
+    extensions = [".jpg", ".png", ".mp4", ".avi", ".txt", ".zip"]
+
+    for model in range(models):
+        model_dir = root / f"Model{model}"
+        for subfolder in ["images", "videos"]:
+            (model_dir / subfolder).mkdir(parents=True)
+
+        for number in range(files):
+            extension = extensions[number % len(extensions)]
+            name = f"pic_{number}{extension}"
+            if number % 7 == 0:
+                name = f"fansly_{number}{extension}"
+
+            # a third of the files are loose in the model folder
+            if number % 3 == 0:
+                file_path = model_dir / name
+            elif extension in [".mp4", ".avi"]:
+                file_path = model_dir / "videos" / name
+            else:
+                file_path = model_dir / "images" / name
+
+            file_path.write_bytes(f"{model}:{number}".encode() * 8)
+
+        # the same name loose and inside a subfolder
+        (model_dir / "clash.jpg").write_bytes(b"loose")
+        (model_dir / "images" / "clash.jpg").write_bytes(b"filed already")
+
+
+def build_archive_tree(root: Path, models: int, files: int) -> None:
+    for model in range(models):
+        model_dir = root / f"Model{model}"
+        (model_dir / "images").mkdir(parents=True)
+        (model_dir / "misc").mkdir()
+
+        # members are filed by their name alone, it differs between archives
+        # because which one gets a clashing name first would depend on timing
+        for archive_name in ["set.zip", "fansly_set.zip"]:
+            stem = archive_name[:-4]
+            write_zip(
+                model_dir / archive_name,
+                {
+                    f"{stem}/{stem}_pic_{number}{extension}": f"{model}:{number}"
+                    for number in range(files // 10)
+                    for extension in [".jpg", ".mp4", ".txt"]
+                },
+            )
+
+        # one member is in place already, another has a different file by its name
+        (model_dir / "images" / "set_cover.jpg").write_bytes(b"cover")
+        (model_dir / "images" / "set_other.jpg").write_bytes(b"other")
+        write_zip(
+            model_dir / "covers.zip",
+            {"set_cover.jpg": "cover", "set_other.jpg": "not the other"},
+        )
+
+        # filed by an earlier run, and one that can't be read
+        write_zip(model_dir / "misc" / "old.zip", {"old.jpg": "old"})
+        (model_dir / "broken.zip").write_bytes(b"not a zip")
+
+        (model_dir / "loose.jpg").write_bytes(f"{model}:loose".encode())
+
+
+def write_zip(archive_path: Path, members: dict) -> None:
+    # a fixed date, so the archives of every engine's tree are identical
+
+    with zipfile.ZipFile(archive_path, "w") as archive:
+        for name, content in members.items():
+            archive.writestr(zipfile.ZipInfo(name, (2020, 1, 1, 0, 0, 0)), content)
+
+
+def load_config() -> dict:
+    with open(Path(__file__).with_name("config.yaml"), "r") as f:
+        return yaml.safe_load(f)
+
+
+def get_leftover_extensions() -> set:
+    config = load_config()
+    filetypes = config["valid_filetypes"]
+    return (set(filetypes["images"]) - set(config["goal_image_extensions"])) | (
+        set(filetypes["videos"]) - set(config["goal_video_extensions"])
+    )
+
+
+def write_config(work_dir: Path, overrides: dict) -> Path:
+    config = load_config()
+
+    config.update(
+        root_dir=str(work_dir / "ISOs"),
+        completion_json=str(work_dir / "index.json"),
+        history_file=str(work_dir / "history.json"),
+        checkpoint_file=str(work_dir / "checkpoint.jsonl"),
+        leftovers_report=str(work_dir / "leftovers.csv"),
+        image_hash_cache=str(work_dir / "image_hashes.json"),
+        video_fingerprint_cache=str(work_dir / "video_fingerprints.json"),
+        metadata_cache=str(work_dir / "metadata_cache.json"),
+        metadata_index=str(work_dir / "metadata.json"),
+        recompress_cache=str(work_dir / "recompress_cache.json"),
+        blacklist_hash_cache=str(work_dir / "blacklist_hashes.json"),
+        previous_index=str(work_dir / "index.previous.jsonl"),
+        thumbnail_dir=str(work_dir / "thumbnails"),
+        run_diff_report=None,
+        is_dry_run=False,
+        is_debug=False,
+        do_imports=True,
+        do_premium_imports=True,
+        do_loose_file_imports=True,
+        do_renames=True,
+        do_converts=False,
+        do_thumbnails=False,
+        do_find_similar_images=False,
+        do_find_duplicate_videos=False,
+        do_extract_metadata=False,
+        do_recompress_images=False,
+        do_archive_imports=False,
+        do_run_diff=False,
+        blacklisted_files=[],
+        protected_models=[],
+        protected_dirs=["premium"],
+    )
+    config.update(overrides)
+
+    config_path = work_dir / "config.yaml"
+    with open(config_path, "w") as f:
+        yaml.safe_dump(config, f)
+
+    return config_path
+
+
+def run_engine(processor_class, config_path: Path) -> None:
+    # the pool workers are forked, so they read the same config
+    # only the main process gets the enter that process_root waits for at the end
+    # a worker that prompts fails, so the check catches it
+    original_init = app.Config.__init__
+    original_stdin = sys.stdin
+
+    def config_init(self):
+        self.config_path = config_path
+        self.load_config()
+
+    app.Config.__init__ = config_init
+    sys.stdin = io.StringIO("\n")
+    try:
+        processor_class(4).process_root()
+    finally:
+        app.Config.__init__ = original_init
+        sys.stdin = original_stdin
+
+
+def collect_output(work_dir: Path) -> dict:
+    root = work_dir / "ISOs"
+
+    with open(work_dir / "history.json", "r") as f:
+        history = json.load(f)
+
+    # uuids and timestamps differ between runs, the moves themselves must not
+    moves = [
+        (
+            os.path.relpath(entry["input_path"], root),
+            os.path.relpath(entry["output_path"], root),
+        )
+        for entry in history.values()
+        if "input_path" in entry
+    ]
+
+    leftovers_report = work_dir / "leftovers.csv"
+    leftovers = ""
+    if leftovers_report.exists():
+        leftovers = leftovers_report.read_text().replace(str(root), "")
+
+    return {
+        "index": (work_dir / "index.json").read_text(),
+        "history": moves,
+        "leftovers": leftovers.splitlines(),
+        "files": sorted(
+            (str(path.relative_to(root)), path.read_bytes())
+            for path in root.rglob("*")
+            if path.is_file()
+        ),
+    }
+
+
+def get_unordered(output: dict) -> dict:
+    index = json.loads(output["index"])
+    return {
+        "index": sorted(
+            (model, name, file_name)
+            for model, subfolders in index.items()
+            for subfolder in subfolders
+            for name, names in subfolder.items()
+            for file_name in names
+        ),
+        "history": sorted(output["history"]),
+        "leftovers": sorted(output["leftovers"]),
+        "files": output["files"],
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=int, default=8)
+    parser.add_argument("--files", type=int, default=60)
+    args = parser.parse_args()
+
+    engines = {
+        "sync": app.FileProcessor,
+        "async": app.AsyncFileProcessor,
+        "process": app.ProcessFileProcessor,
+    }
+
+    # (build the tree, config overrides, engines compared in order)
+    scenarios = {
+        "loose files": (build_tree, dict(), ["process"]),
+        "archives": (build_archive_tree, dict(do_archive_imports=True), []),
+    }
+
+    failures = list()
+    for scenario, (build, overrides, ordered_engines) in scenarios.items():
+        base_dir = Path(tempfile.mkdtemp())
+        try:
+            outputs = dict()
+            for name, processor_class in engines.items():
+                work_dir = base_dir / name
+                build(work_dir / "ISOs", args.models, args.files)
+
+                run_engine(processor_class, write_config(work_dir, overrides))
+                outputs[name] = collect_output(work_dir)
+        finally:
+            shutil.rmtree(base_dir)
+
+        failures.extend(
+            f"{scenario}: {failure}"
+            for failure in compare_outputs(outputs, ordered_engines)
+        )
+
+    print("\n".join(failures) if failures else "engines match")
+    sys.exit(1 if failures else 0)
+
+
+def compare_outputs(outputs: dict, ordered_engines: list) -> list:
+    expected = outputs.pop("sync")
+    failures = list()
+    for name, output in outputs.items():
+        expected_output = expected
+        if name not in ordered_engines:
+            expected_output = get_unordered(expected)
+            output = get_unordered(output)
+
+        for key in expected_output:
+            if output[key] != expected_output[key]:
+                failures.append(f"{name}: {key} differs from the default engine")
+
+    # a file is indexed once, where it ended up
+    index = json.loads(expected["index"])
+    if not index:
+        failures.append("the default engine indexed nothing")
+    for model, subfolders in index.items():
+        for subfolder in subfolders:
+            for name, names in subfolder.items():
+                if len(names) != len(set(names)):
+                    failures.append(f"{model}/{name} lists a file twice")
+
+    # so the index lists what a crawl after the run would find
+    on_disk = sorted(
+        (parts[0], parts[-2], parts[-1])
+        for parts in (Path(path).parts for path, _ in expected["files"])
+        if "premium" not in parts[1:-1]
+    )
+    if get_unordered(expected)["index"] != on_disk:
+        failures.append("the index doesn't match the files left on disk")
+
+    leftover_extensions = get_leftover_extensions()
+    leftovers_on_disk = sorted(
+        os.sep + os.path.join(*parts)
+        for parts in (Path(path).parts for path, _ in expected["files"])
+        if "premium" not in parts[1:-1]
+        and Path(parts[-1]).suffix.lower() in leftover_extensions
+    )
+    leftovers = sorted(line.split(",")[2] for line in expected["leftovers"][1:])
+    if leftovers != leftovers_on_disk:
+        failures.append("the leftovers don't match the files left on disk")
+
+    return failures
+
+
+if __name__ == "__main__":
+    main()
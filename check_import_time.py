@@ -0,0 +1,77 @@
+import re
+import sys
+import argparse
+import statistics
+import subprocess
+from pathlib import Path
+
+# fails when "import app" gets slow again or loads a dependency it shouldn't
+# PIL, yaml and asyncio are only needed by some runs and are imported where used
+#
+#   python check_import_time.py
+#   python check_import_time.py --budget 200 --runs 9
+
+lazy_modules = ["PIL", "yaml", "asyncio", "concurrent.futures", "multiprocessing"]
+
+
+def get_import_time(app_dir: Path) -> float:
+    # the cumulative time of the app module in milliseconds, from python -X importtime
+    # every run is a fresh interpreter, so nothing is imported already
+
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=app_dir,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    match = re.search(r"^import time:\s+\d+ \|\s+(\d+) \| app$", result.stderr, re.M)
+    if match is None:
+        raise RuntimeError("python -X importtime did not report the app module")
+
+    return int(match.group(1)) / 1000
+
+
+def get_loaded_modules(app_dir: Path) -> list:
+    result = subprocess.run(
+        [
+            sys.executable,
+            "-c",
+            "import sys, app; print(*sys.modules, sep='\\n')",
+        ],
+        cwd=app_dir,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    loaded = set(result.stdout.split())
+    return [module for module in lazy_modules if module in loaded]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--budget", type=float, default=150, help="milliseconds")
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    app_dir = Path(__file__).parent
+    failures = list()
+
+    # the median keeps one slow run on a busy machine from failing the check
+    times = [get_import_time(app_dir) for _ in range(args.runs)]
+    import_time = statistics.median(times)
+    print(f"import app: {import_time:.1f} ms (median of {args.runs} runs)")
+    if import_time > args.budget:
+        failures.append(f"import app took {import_time:.1f} ms, over {args.budget} ms")
+
+    for module in get_loaded_modules(app_dir):
+        failures.append(f"import app loaded {module}")
+
+    print("\n".join(failures) if failures else "import is lean")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -3,6 +3,8 @@ author: ne0liberal
 root_dir: D:/Content/ISOs
 completion_json: D:/Content/index.json
 history_file: D:/Content/history/history.json
+checkpoint_file: D:/Content/history/checkpoint.jsonl
+leftovers_report: D:/Content/leftovers.csv
 premium_directory: premium
 output_attributes: false
 is_dry_run: true
@@ -23,6 +25,62 @@ do_import_gumroad: true
 do_import_onlyfans: true
 do_import_patreon: true
 do_import_ppv: true
+move_workers: 4
+move_bandwidth_limit: 0
+move_verify_hash: true
+async_disk_limit: 16
+async_encoder_limit: 2
+async_probe_limit: 8
+async_max_in_flight: 512
+do_find_similar_images: false
+similar_images_hash: dhash
+similar_images_threshold: 6
+image_hash_cache: D:/Content/history/image_hashes.json
+similar_images_report: D:/Content/similar_images.json
+do_find_duplicate_videos: false
+video_fingerprint_workers: 2
+video_fingerprint_threshold: 8
+video_fingerprint_cache: D:/Content/history/video_fingerprints.json
+duplicate_videos_report: D:/Content/duplicate_videos.json
+do_extract_metadata: false
+metadata_workers: 8
+metadata_cache: D:/Content/history/metadata_cache.json
+metadata_index: D:/Content/metadata.json
+do_thumbnails: false
+thumbnail_workers: 4
+thumbnail_size: 256
+thumbnail_sheet_frames: 4
+thumbnail_dir: D:/Content/thumbnails
+do_recompress_images: false
+recompress_quality: 85
+recompress_lossless_webp: false
+recompress_min_savings: 10
+recompress_cache: D:/Content/history/recompress_cache.json
+transcode_profile: fast
+transcode_timeout: 1800
+transcode_profiles:
+    fast:
+        preset: veryfast
+        crf: 23
+        threads: 0
+    balanced:
+        preset: medium
+        crf: 21
+        threads: 0
+    small:
+        preset: slow
+        crf: 26
+        threads: 0
+do_archive_imports: false
+archive_workers: 2
+archive_max_member_size: 4096
+archive_max_total_size: 32768
+archive_extractor: 7z
+archive_delete_after_import: false
+do_query_index: false
+do_run_diff: false
+previous_index: D:/Content/index.previous.jsonl
+run_diff_report: D:/Content/run_diff.txt
 valid_filetypes:
     audio:
     - .mp3
@@ -105,3 +163,4 @@ protected_dirs:
 - youtube
 blacklisted_files:
 - D:/Content/ISOs/unknown/image.jpg
+blacklist_hash_cache: D:/Content/history/blacklist_hashes.json